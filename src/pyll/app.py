@@ -1,21 +1,36 @@
-import BaseHTTPServer
+import atexit
 from codecs import open
 from datetime import datetime
+from functools import partial
 import imp
+from itertools import izip
 import logging
+import shutil
 import ConfigParser
 from optparse import OptionParser
+import os
 from os import makedirs, getcwd, getlogin
-from os.path import splitext, join, dirname, split, abspath, getctime,\
+from os.path import splitext, join, dirname, split, abspath,\
                     basename, exists, relpath, isabs
-from shutil import rmtree
+from stat import S_ISREG
 import sys
+from tempfile import mkdtemp
+import threading
 import time
 
-from pyll import __version__, parser, autoreload
-from pyll.url import get_url
-from pyll.utils import copy_file, walk_ignore, OrderedDict
-from pyll.server import LanyonHTTPRequestHandler
+from pyll import __version__, parser, autoreload, compress, highlight
+from pyll.cache import FileCache
+from pyll.manifest import Manifest, get_fingerprint, get_hash,\
+                          get_page_hash, save_changes
+from pyll.url import get_url, compile_registry, UrlException
+from pyll.output import OutputDir, MemoryOutput
+from pyll.page import Page
+from pyll.index import SiteIndex, UrlIndex
+from pyll.profiler import Profiler, get_max_rss
+from pyll.utils import scan, get_ignore_func, imap_jobs, OrderedDict,\
+                       IGNORE_PATTERNS, get_hash_from_path
+from pyll.server import LanyonHTTPRequestHandler, ThreadingHTTPServer,\
+                        ReloadNotifier
 from pyll.template import Jinja2Template, TemplateException
 
 LOGGING_LEVELS = {'info': logging.INFO, 'debug': logging.DEBUG}
@@ -25,6 +40,54 @@ class Site(object):
         self.settings = settings
         self.pages = []
         self.static_files = []
+        # build state of the current and the last build (incremental mode)
+        self.manifest = None
+        self.last_manifest = None
+        # persistent cache of parser results, keyed by source and parser
+        self.parse_cache = None
+        # persistent cache of {% cache %} template fragments
+        self.fragment_cache = None
+        if self.settings.get('use_cache'):
+            self.parse_cache = FileCache(
+                    join(self.settings['cache_dir'], 'parsed'),
+                    int(self.settings.get('parse_cache_size', 256)) << 20)
+            self.fragment_cache = FileCache(
+                    join(self.settings['cache_dir'], 'fragments'),
+                    int(self.settings.get('fragment_cache_size', 64)) << 20)
+        # where the parsed pages are kept until they are rendered. in
+        # streaming mode they are written to a temporary directory if
+        # there is no parse cache.
+        self.content_store = self.parse_cache
+        if self.settings.get('stream') and self.content_store is None:
+            directory = mkdtemp(prefix='pyll-')
+            atexit.register(shutil.rmtree, directory, True)
+            self.content_store = FileCache(directory, 0)
+        # persistent cache of highlighted code blocks, used by the parsers
+        self.highlight_cache = highlight.get_cache(self.settings)
+        self._parser_keys = {}
+        # where the generated site is written to
+        if self.settings.get('in_memory'):
+            self.output = MemoryOutput(self.settings['output_dir'])
+        else:
+            self.output = OutputDir(
+                    self.settings['output_dir'],
+                    self.settings.get('static_mode', 'copy'),
+                    int(self.settings.get('copy_threads', 4)))
+        # the paths that changed since the last run, None if unknown
+        self.changed = None
+        # True if the last run raised an exception
+        self._failed = False
+        # timings of the current run, recorded with --profile
+        self.profiler = Profiler()
+        # state of the last run that is reused by rebuilds (watch mode)
+        self._input_data = None
+        self._files = set()
+        self._parsed = {}
+        # maps the paths of all files found by _read_files() to their stat
+        self._stats = {}
+        # names of files and directories that aren't part of the site
+        ignore = tuple(self.settings.get('ignore', '').split())
+        self.ignore = get_ignore_func(IGNORE_PATTERNS + ignore)
 
         # import custom urls
         try:
@@ -32,22 +95,40 @@ class Site(object):
         except IOError as e:
             logging.debug('couldn\'t load urls from "%s": %s',
                           self.settings['url_path'], e)
+        compile_registry()
 
     def _read_files(self):
         """
-        Walks through the project directory and separates files into 
+        Scans the project directory and separates files into
         parseable files (file extensions for which a parser exists)
-        and static files (file extensions for which no parser exists)
+        and static files (file extensions for which no parser exists).
+        The stat results of all files are kept in `_stats`.
         """
+        project_dir = self.settings['project_dir']
         data = OrderedDict()
-        for root, dirs, files in walk_ignore(self.settings['project_dir']):
-            pages = [] # parseable files; rename to (pages)
-            static = [] # rename to (static)
+        stats = {}
+        # maps directories to their parent dirs that contain pages
+        page_parents = {project_dir: ()}
+        # maps file extensions to True if a parser exists for them
+        parseable = {}
+        for root, dirs, files in scan(project_dir, self.ignore):
+            if root != project_dir:
+                parent_dir = dirname(root)
+                page_parents[root] = page_parents[parent_dir]
+                if parent_dir in data and parent_dir != project_dir:
+                    page_parents[root] += (parent_dir,)
 
+            pages = []
+            static = []
             # check if a parser exists and append to corresponding list
-            for file in files:
-                path = join(root, file)
-                if parser.get_parser_for_filename(path):
+            for filename, stat in files:
+                path = join(root, filename)
+                stats[path] = stat
+                ext = splitext(filename)[1]
+                if ext not in parseable:
+                    parseable[ext] = \
+                            bool(parser.get_parser_for_filename(filename))
+                if parseable[ext]:
                     pages.append(path)
                 else:
                     static.append(path)
@@ -56,23 +137,15 @@ class Site(object):
             if pages:
                 data[root] = (pages, static)
             elif static:
-                # dir has static file(s) but no pages. check if one of
-                # the parent dirs has a page and associate the static files
-                # with it
-                has_parent = False
-                if root != self.settings['project_dir']:
-                    parent_dir = dirname(root)
-                    while parent_dir != self.settings['project_dir']:
-                        if parent_dir in data:
-                            data.setdefault(parent_dir, ([], []))[1].\
-                                    extend(static)
-                            has_parent = True
-                        parent_dir = dirname(parent_dir)
+                # dir has static file(s) but no pages. associate the
+                # static files with the parent dirs that have pages
+                for parent_dir in page_parents[root]:
+                    data[parent_dir][1].extend(static)
                 # if no parent dir could be found, or the file is in the
                 # root dir associate the files with the root of the project dir
-                if not has_parent:
-                    data.setdefault(self.settings['project_dir'],
-                                    ([], []))[1].extend(static)
+                if not page_parents[root]:
+                    data.setdefault(project_dir, ([], []))[1].extend(static)
+        self._stats = stats
         return data
 
     def _get_default_headers(self, path):
@@ -100,7 +173,8 @@ class Site(object):
             slug = filename
         title = filename.title()
         try:
-            date = datetime.fromtimestamp(getctime(path))
+            stat = self._stats.get(path) or os.stat(path)
+            date = datetime.fromtimestamp(stat.st_ctime)
         except OSError:
             # use the current date if the ctime cannot be accessed
             date = datetime.now()
@@ -110,9 +184,19 @@ class Site(object):
                     output_ext=output_ext)
 
     def _parse(self, input_data):
-        "Parses the input data"
+        """
+        Parses the input data in two passes. The first pass reads only the
+        headers of every page to skip drafts and future-dated pages and to
+        set the url; the second pass converts the body of the remaining
+        pages.
+        """
+        pages = []
+        # maps paths to the url header value the url was built from
+        url_rules = {}
+        # page dates are naive local times, see parser.parse_date()
+        now = datetime.today()
         for input_dir in input_data:
-            pages, static_files = input_data[input_dir]
+            paths, static_files = input_data[input_dir]
 
             # special case: static files at the top level of the project dir 
             # are not associated with any pages
@@ -120,51 +204,184 @@ class Site(object):
                 self.static_files = static_files
                 static_files = []
 
-            for path in pages:
-                page = dict(static_files=static_files)
+            for path in paths:
+                page = Page(static_files=static_files)
                 page.update(self._get_default_headers(path))
-
-                # parse the page
-                parser_cls = parser.get_parser_for_filename(page['path'])
-                with open(path, 'r', encoding='utf8') as f:
-                    parser_inst = parser_cls(self.settings, f.read())
-
+                parser_cls = parser.get_parser_for_filename(path)
                 try:
-                    parsed = parser_inst.parse()
-                except parser.ParserException as parser_error:
-                    logging.error(parser_error)
+                    page.update(self._read_headers(path, parser_cls))
+                except parser.ParserException as error:
+                    logging.error(error)
                     logging.error('skipping article "%s"', path)
                     continue
-
-                # update the values in the page dict
-                page.update(content=parsed[1], **parsed[0])
                 if parser_cls.output_ext:
                     page.update(output_ext=parser_cls.output_ext)
+                if self._is_skipped(page, now):
+                    continue
 
-                # skip drafts
-                if page['status'] == 'draft':
-                    logging.debug('skipping %s (draft)', path)
+                # update the url
+                url_rules[path] = page['url']
+                page['url'] = get_url(page)
+                pages.append((path, page) + self._read_source(path))
+
+        # parse the sources that can't be reused from the last build. with
+        # more than one job they are parsed in worker processes; the results
+        # are returned in input order.
+        # in streaming mode the sources aren't kept in memory but read again
+        # by the parse jobs
+        stream = self.settings.get('stream')
+        to_parse = [(parser_cls, self.settings, path if stream else source)
+                    for path, _, parser_cls, _, source, parsed in pages
+                    if parsed is None]
+        parse_func = parser.parse_file if stream else parser.parse_source
+        results = imap_jobs(self.profiler.wrap(parse_func), to_parse,
+                            self.settings.get('jobs', 1))
+        if to_parse and self.highlight_cache is not None:
+            # code blocks may have been highlighted by worker processes
+            self.highlight_cache.changed = True
+
+        parsed_sources = {}
+        for path, page, parser_cls, source_hash, source, parsed in pages:
+            if source_hash is not None:
+                page.content_key = self._get_cache_key(parser_cls,
+                                                       source_hash)
+            if parsed is None:
+                parsed = self.profiler.unwrap(next(results), 'parse',
+                                              page['path'])
+                if isinstance(parsed, parser.ParserException):
+                    logging.error(parsed)
+                    logging.error('skipping article "%s"', path)
                     continue
-                # skip pages with a date that is in the future
-                elif page['date'] > datetime.today():
-                    logging.debug('skipping %s (future-dated)', path)
+                if self.content_store is not None:
+                    self.content_store.set(page.content_key, parsed)
+            self._record_parsed(page['path'], parser_cls, source_hash, parsed)
+
+            # parsers may add or change headers while converting the body
+            url_rule = parsed[0].get('url', url_rules[path])
+            if url_rule != url_rules[path] or any(
+                    page.get(key) != value
+                    for key, value in parsed[0].iteritems() if key != 'url'):
+                page.update(parsed[0])
+                if parser_cls.output_ext:
+                    page.update(output_ext=parser_cls.output_ext)
+                if self._is_skipped(page, now):
                     continue
-                
-                # update the url
+                page['url'] = url_rule
                 page['url'] = get_url(page)
 
-                self.pages.append(page)
-                sys.stdout.write('.')
+            content = parsed[1]
+            if self.content_store is not None:
+                # the content is loaded from the store when it's used and
+                # can be released again. without a store it's kept, as
+                # loading it would mean parsing the page again.
+                page.content_loader = partial(_load_content,
+                                              self.content_store,
+                                              parser_cls, self.settings)
+                content = None
+            page.content = content
+            if self.settings.get('watch'):
+                parsed_sources[path] = (source_hash, (parsed[0], content))
+            self.pages.append(page)
+            sys.stdout.write('.')
         sys.stdout.write('\n')
+        self._parsed = parsed_sources
+
+    def _is_skipped(self, page, now):
+        "Returns True if `page` is a draft or dated after `now`"
+        if page['status'] == 'draft':
+            logging.debug('skipping %s (draft)', page['path'])
+            return True
+        elif page['date'] > now:
+            logging.debug('skipping %s (future-dated)', page['path'])
+            return True
+        return False
+
+    def _read_headers(self, path, parser_cls):
+        """
+        Returns the headers of the page `path`, reusing them from the last
+        run if the file didn't change since.
+        """
+        if self.changed is not None and path not in self.changed and \
+           path in self._parsed:
+            return self._parsed[path][1][0]
+        return parser.read_headers(parser_cls, self.settings, path)
+
+    def _read_source(self, path):
+        """
+        Reads the page `path` and returns a tuple of
+        (parser_cls, source_hash, source, parsed).
+
+        `parsed` is the (headers, text) tuple from the last run (if the
+        file didn't change since) or the parse cache, or None if the source
+        has to be parsed. `text` is None if it was released from memory.
+        """
+        parser_cls = parser.get_parser_for_filename(path)
+        if self.changed is not None and path not in self.changed and \
+           path in self._parsed:
+            source_hash, parsed = self._parsed[path]
+            return parser_cls, source_hash, None, parsed
+
+        with open(path, 'r', encoding='utf8') as f:
+            source = f.read()
+        if self.content_store is None and self.manifest is None:
+            return parser_cls, None, source, None
+
+        source_hash = get_hash(source)
+        parsed = None
+        if self.parse_cache is not None:
+            parsed = self.parse_cache.get(
+                    self._get_cache_key(parser_cls, source_hash))
+            if parsed is not None:
+                logging.debug('reusing parsed %s (cached)', path)
+        if self.settings.get('stream'):
+            # read again by parser.parse_file()
+            source = None
+        return parser_cls, source_hash, source, parsed
+
+    def _get_cache_key(self, parser_cls, source_hash):
+        "Returns the parse cache key for a source parsed with `parser_cls`"
+        if parser_cls not in self._parser_keys:
+            self._parser_keys[parser_cls] = \
+                    parser_cls.get_cache_key(self.settings)
+        return get_hash(self._parser_keys[parser_cls] + source_hash)
+
+    def _record_parsed(self, path, parser_cls, source_hash, parsed):
+        "Records the parsed page `path` in the manifest"
+        if self.manifest is not None:
+            self.manifest.pages[path] = dict(source_hash=source_hash,
+                                             parser=parser_cls.__name__,
+                                             headers=parsed[0])
 
     def _sort(self):
         "Sort pages by date (newest first)"
         self.pages.sort(key=lambda p: p['date'], reverse=True)
 
-    def _delete_output_dir(self):
-        "Deletes the output directory"
-        if exists(self.settings['output_dir']):
-            rmtree(self.settings['output_dir'])
+    def _prepare_output_dir(self):
+        """
+        Prepares a build from scratch. The files are written to a staging
+        directory that replaces the output directory after the build, so
+        the output of the last build stays in place until then. Output
+        in memory is cleared instead; run() already started a build on a
+        copy of it, which is only served once the build succeeded.
+        """
+        if self.output.persistent:
+            self.output.begin()
+        else:
+            self.output.clear()
+
+    def _delete_vanished_files(self):
+        """
+        Deletes the files of the last build, including their compressed
+        siblings, that aren't part of this build
+        """
+        vanished = self.last_manifest.get_output_paths() - \
+                   self.manifest.get_output_paths()
+        for output_path in sorted(vanished):
+            path = join(self.settings['output_dir'], output_path)
+            logging.debug('deleting %s', path)
+            for sibling_path in compress.get_sibling_paths(path):
+                self.output.remove(sibling_path)
+            self.output.remove(path)
 
     def _is_public(self, page):
         "Return True if page is public"
@@ -185,50 +402,185 @@ class Site(object):
             output_path = url
         return join(self.settings['output_dir'], output_path)
 
+    def _is_unchanged(self, page, output_paths, template_cls):
+        """
+        Records the render inputs of `page` in the manifest and returns
+        True if they are the same as in the last build and the output
+        files still exist. `output_paths` are the output path of the page
+        followed by the ones of its paginated listings.
+        """
+        if page['template'] == 'self':
+            variables = template_cls.get_variables(source=page['content'])
+            uses_contents = template_cls.reads_page_contents(
+                    source=page['content'])
+            page.release_content()
+        else:
+            variables = template_cls.get_variables(page['template'])
+            uses_contents = template_cls.reads_page_contents(
+                    page['template'])
+        output_dir = self.settings['output_dir']
+        entry = self.manifest.pages[page['path']]
+        uses_pages = variables is None or 'paginate' in page or \
+                     bool(variables & set(['pages', 'site']))
+        entry.update(template=page['template'],
+                     output_path=relpath(output_paths[0], output_dir),
+                     listing_paths=[relpath(path, output_dir)
+                                    for path in output_paths[1:]],
+                     render_hash=get_page_hash(page),
+                     uses_pages=uses_pages,
+                     uses_contents=uses_pages and uses_contents,
+                     uses_urls=variables is None or 'url_for' in variables)
+
+        last, current = self.last_manifest, self.manifest
+        last_entry = last.pages.get(page['path'])
+        if not last_entry or last_entry.get('templates') is None or \
+           not all(self.output.exists(path) for path in output_paths):
+            return False
+        if entry['uses_pages'] and last.pages_hash != current.pages_hash:
+            return False
+        # most templates only read the headers of other pages
+        if entry['uses_contents'] and \
+           last.contents_hash != current.contents_hash:
+            return False
+        # url_for() knows the urls of all pages, including hidden ones
+        if entry['uses_urls'] and last.urls_hash != current.urls_hash:
+            return False
+        if any(last_entry.get(key) != entry[key]
+               for key in ('output_path', 'listing_paths', 'render_hash')):
+            return False
+
+        # check if any of the templates loaded by the last render changed
+        for name in last_entry['templates']:
+            if last.template_hashes.get(name) != \
+               self._record_template(name, template_cls):
+                return False
+        entry['templates'] = last_entry['templates']
+        return True
+
+    def _record_template(self, template_name, template_cls):
+        "Records the hash of `template_name` in the manifest and returns it"
+        template_hash = template_cls.get_template_hash(template_name)
+        self.manifest.template_hashes[template_name] = template_hash
+        return template_hash
+
+    def _get_collision(self, first, second, output_path):
+        """
+        Returns the UrlException for two (page, listing value) tuples that
+        are written to the same `output_path`.
+        """
+        output_path = relpath(output_path, self.settings['output_dir'])
+        if first[0] is not second[0]:
+            return UrlException('"%s" and "%s" are both written to "%s"' % (
+                    first[0]['path'], second[0]['path'], output_path))
+        # e.g. the listings of the tags "C++" and "C#"
+        return UrlException(
+                '"%s" writes the listings of "%s" and "%s" to "%s"' % (
+                first[0]['path'], first[1], second[1], output_path))
+
     def _write(self):
-        "Writes the parsed data to the filesystem"
+        """
+        Writes the parsed data to the filesystem. Returns the list of
+        output paths that were written.
+        """
         public_pages = filter(self._is_public, self.pages)
-        template_cls = Jinja2Template(self.settings)
-        for page in self.pages:
-            output_path = self._get_output_path(page['url'])
-
-            # create the directories for the page
-            try:
-                makedirs(dirname(output_path))
-            except OSError:
-                pass
+        site = SiteIndex(public_pages,
+                         self.settings.get('list_headers', 'tags').split())
+        url_for = UrlIndex(self.pages)
+        # the page hashes only cover the content if the source was hashed.
+        # the fragment cache can't tell which pages a fragment reads the
+        # content of, so its hash covers the headers and the content.
+        pages_hash = fragments_hash = None
+        if self.manifest is not None or self.parse_cache is not None:
+            pages_hash = get_hash(''.join(get_page_hash(page, False)
+                                          for page in public_pages))
+            contents_hash = get_hash(repr([page.content_key
+                                           for page in public_pages]))
+            fragments_hash = get_hash(pages_hash + contents_hash)
+        if self.manifest is not None:
+            template_cls = Jinja2Template(self.settings)
+            self.manifest.pages_hash = pages_hash
+            self.manifest.contents_hash = contents_hash
+            self.manifest.urls_hash = url_for.get_hash()
 
-            # render template with Jinja2
-            if page['template'] == 'self':
-                render_func = template_cls.render_string
-                template = page['content']
-            else:
-                render_func = template_cls.render
-                template = page['template']
+        # collect the pages that have to be rendered. a page with a
+        # `paginate` header is rendered once for every listing page.
+        jobs = []
+        # maps output paths to the page and listing value written to them
+        output_pages = {}
+        for index, page in enumerate(self.pages):
+            page_jobs = [(index, self._get_output_path(page['url']), None)]
+            for value, urls in site.get_listings(page):
+                for number, url in enumerate(urls, 1):
+                    listing = (value, number, urls)
+                    if url == page['url']:
+                        page_jobs[0] = page_jobs[0][:2] + (listing,)
+                    else:
+                        page_jobs.append(
+                                (index, self._get_output_path(url), listing))
+            for index, output_path, listing in page_jobs:
+                value = listing and listing[0]
+                if output_path in output_pages:
+                    raise self._get_collision(output_pages[output_path],
+                                              (page, value), output_path)
+                output_pages[output_path] = (page, value)
+            if self.manifest is not None and self._is_unchanged(
+                    page, [job[1] for job in page_jobs], template_cls):
+                logging.debug('skipping %s (unchanged)', page['path'])
+                continue
+            jobs.extend(page_jobs)
 
-            try:
-                rendered = render_func(template,
-                                       page=page,
-                                       pages=public_pages,
-                                       settings=self.settings)
-            except TemplateException as error:
+        # render and write the pages. with more than one job this happens
+        # in worker processes, each with its own Jinja2 environment.
+        results = imap_jobs(self.profiler.wrap(_render_page), jobs,
+                            self.settings.get('jobs', 1),
+                            initializer=_init_renderer,
+                            initargs=(self.settings, self.pages, public_pages,
+                                      site, url_for, self.fragment_cache,
+                                      fragments_hash, self.output))
+        written = []
+        for (index, output_path, listing), result in izip(jobs, results):
+            page = self.pages[index]
+            error, templates, rendered, changed = self.profiler.unwrap(
+                    result, 'render',
+                    relpath(output_path, self.settings['output_dir']))
+            if rendered is not None:
+                changed = self.output.write(output_path, rendered)
+            if self.manifest is not None:
+                entry = self.manifest.pages[page['path']]
+            if error is not None:
                 logging.error(error)
                 logging.error('skipping article "%s"', page['path'])
+                if self.manifest is not None:
+                    # forget the output so it's rendered again next time
+                    entry['render_hash'] = None
+                    if output_path == self._get_output_path(page['url']):
+                        entry['output_path'] = None
                 continue
-
-            # write to filesystem
-            logging.debug("writing %s to %s", page['path'], output_path)
-            with open(output_path, 'w', 'utf-8') as f:
-                f.write(rendered)
+            written.append(output_path)
+            self._sources[output_path] = page['path']
+            if not changed:
+                self._unchanged.add(output_path)
+            if self.manifest is not None:
+                entry['templates'] = sorted(
+                        set(entry.get('templates') or ()) | templates)
+                for name in templates:
+                    self._record_template(name, template_cls)
+        if jobs and self.fragment_cache is not None:
+            # fragments may have been stored by worker processes
+            self.fragment_cache.changed = True
+        return written
 
     def _copy_static_files(self):
-        "Copies static files to output directory"
+        """
+        Copies static files to output directory. Returns the list of
+        output paths that were copied.
+        """
+        files = []
         # static files that aren't associated with pages
         for static_file in self.static_files:
             dst = join(self.settings['output_dir'],
                        relpath(static_file, self.settings['project_dir']))
-            logging.debug('copying %s to %s', static_file, dst)
-            copy_file(static_file, dst)
+            files.append((static_file, dst))
 
         # static files that are associated with pages
         for page in self.pages:
@@ -236,23 +588,429 @@ class Site(object):
                 dst = join(self.settings['output_dir'],
                            dirname(self._get_output_path(page['url'])),
                            relpath(static_file, dirname(page['path'])))
-                logging.debug('copying %s to %s', static_file, dst)
-                copy_file(static_file, dst)
+                files.append((static_file, dst))
+
+        for src, dst in files:
+            self._sources[dst] = relpath(src, self.settings['project_dir'])
+        if self.manifest is not None:
+            for src, dst in files:
+                self.manifest.static_files[
+                        relpath(dst, self.settings['output_dir'])] = src
+        # on rebuilds only changed files are copied
+        if self.changed is not None:
+            files = [(src, dst) for src, dst in files
+                     if src in self.changed or not self.output.exists(dst)]
+        for src, dst in files:
+            logging.debug('copying %s to %s', src, dst)
+        copied = self.output.copy_files(files, self._stats)
+        dsts = [dst for src, dst in files]
+        self._unchanged.update(set(dsts).difference(copied))
+        return dsts
 
-    def run(self):
+    def _compress_output(self, written):
+        """
+        Writes gzip and brotli compressed siblings of the HTML, XML, CSS
+        and JS files in `written`. Files whose content didn't change since
+        the last build keep their siblings.
+
+        Incremental builds also compress the files of the last build that
+        have no siblings yet in all formats, and delete the siblings of
+        formats that aren't selected anymore, e.g. all of them if
+        compression is turned off.
+        """
+        names = []
+        if self.settings.get('compress'):
+            names = self.settings.get('compress_formats',
+                                      'gzip brotli').split()
+        levels = {'gzip': int(self.settings.get('gzip_level', 9)),
+                  'brotli': int(self.settings.get('brotli_level', 11))}
+        levels = dict((name, levels[name])
+                      for name in compress.get_formats(names))
+        output_dir = self.settings['output_dir']
+        paths = set(relpath(path, output_dir) for path in written)
+
+        compressed = {}
+        last_formats = set()
+        if self.last_manifest is not None:
+            # keep the hashes of files that weren't written this time
+            output_paths = self.manifest.get_output_paths()
+            compressed = dict(item for item in
+                              self.last_manifest.compressed.iteritems()
+                              if item[0] in output_paths)
+            last_formats = set(self.last_manifest.compress_formats)
+            if levels:
+                # e.g. a format was added or compression turned on
+                paths.update(path for path in output_paths
+                             if path not in compressed or
+                             not last_formats.issuperset(levels))
+            self._delete_compressed(compressed, last_formats, levels)
+        if self.manifest is not None:
+            self.manifest.compressed = compressed
+            self.manifest.compress_formats = sorted(levels)
+        if not levels:
+            return
+
+        paths = [path for path in sorted(paths)
+                 if compress.is_compressible(path) and
+                 not self._keep_compressed(join(output_dir, path), levels)]
+        jobs = [(self.output.get_path(join(output_dir, path)),
+                 compressed.get(path), levels)
+                for path in paths]
+        for path, (data_hash, extensions) in izip(paths, imap_jobs(
+                compress.compress_file, jobs, self.settings.get('jobs', 1))):
+            compressed[path] = data_hash
+            self._written_siblings.update(join(output_dir, path) + extension
+                                          for extension in extensions)
+
+    def _delete_compressed(self, compressed, last_formats, levels):
+        """
+        Deletes the siblings of the files in `compressed` in the formats
+        of the last build that aren't in `levels` anymore. Without any
+        format the files are removed from `compressed`, too.
+        """
+        output_dir = self.settings['output_dir']
+        extensions = [compress.formats[name][0]
+                      for name in last_formats.difference(levels)]
+        if not extensions:
+            return
+        for path in sorted(compressed):
+            for extension in extensions:
+                sibling_path = join(output_dir, path) + extension
+                self.output.remove(sibling_path)
+                self._deleted_siblings.add(sibling_path)
+            if not levels:
+                del compressed[path]
+
+    def _keep_compressed(self, path, names):
+        """
+        Returns True if the file `path` wasn't changed by this build and
+        the siblings in the compression formats `names` that were written
+        for it by the last build are kept.
+        """
+        if path not in self._unchanged:
+            return False
+        return all([self.output.keep(path + compress.formats[name][0])
+                    for name in names])
+
+    def _list_output_dir(self):
+        """
+        Returns a dict that maps the paths of the files in the output
+        directory, relative to it, to the paths of their compressed
+        siblings.
+        """
+        output_dir = self.settings['output_dir']
+        extensions = [extension for extension, func
+                      in compress.formats.itervalues()]
+        paths = set()
+        for dirpath, dirnames, filenames in os.walk(output_dir):
+            paths.update(relpath(join(dirpath, filename), output_dir)
+                         for filename in filenames)
+        files = {}
+        for path in paths:
+            if splitext(path)[1] in extensions and \
+               splitext(path)[0] in paths:
+                continue
+            files[path] = [path + extension for extension in extensions
+                           if path + extension in paths]
+        return files
+
+    def _get_changes(self, written):
+        """
+        Returns the output files that were added, changed and removed
+        compared to the last build, for save_changes(). Must be called
+        before the output is committed.
+        """
+        output_dir = self.settings['output_dir']
+        extensions = [extension for extension, func
+                      in compress.formats.itervalues()]
+        if self.output.stage_path is not None:
+            # the output directory still holds the last build
+            previous = self._list_output_dir()
+        elif self.last_manifest is not None:
+            last_extensions = [
+                    compress.formats[name][0]
+                    for name in self.last_manifest.compress_formats]
+            previous = dict(
+                    (path, [path + extension for extension in last_extensions]
+                     if path in self.last_manifest.compressed else [])
+                    for path in self.last_manifest.get_output_paths())
+        else:
+            previous = {}
+        current = set(relpath(path, output_dir) for path in self._sources)
+        if self.manifest is not None:
+            current.update(self.manifest.get_output_paths())
+
+        changes = dict(added=[], changed=[], removed=[])
+        changed = set(written) - self._unchanged
+        for path in sorted(changed):
+            output_path = relpath(path, output_dir)
+            kind = 'changed' if output_path in previous else 'added'
+            changes[kind].append({
+                    'path': output_path,
+                    'hash': get_hash_from_path(self.output.get_path(path)),
+                    'source': self._sources.get(path),
+                    'compressed': [output_path + extension
+                                   for extension in extensions
+                                   if self.output.exists(path + extension)]})
+        for output_path in sorted(set(previous) - current):
+            changes['removed'].append({'path': output_path,
+                                       'compressed': previous[output_path]})
+
+        # siblings of files that didn't change, e.g. after a compression
+        # format was added or removed, are reported as files of their own
+        previous_siblings = set(sibling for siblings in previous.itervalues()
+                                for sibling in siblings)
+        sources = dict(self._sources)
+        if self.manifest is not None:
+            # the pages that weren't rendered again
+            for source, entry in self.manifest.pages.iteritems():
+                for output_path in [entry.get('output_path')] + \
+                                   entry.get('listing_paths', []):
+                    if output_path:
+                        sources.setdefault(join(output_dir, output_path),
+                                           source)
+        for sibling_path in sorted(self._written_siblings):
+            path = splitext(sibling_path)[0]
+            if path in changed:
+                continue
+            output_path = relpath(sibling_path, output_dir)
+            kind = 'changed' if output_path in previous_siblings else 'added'
+            changes[kind].append({
+                    'path': output_path,
+                    'hash': get_hash_from_path(
+                            self.output.get_path(sibling_path)),
+                    'source': sources.get(path),
+                    'compressed': []})
+        for sibling_path in sorted(self._deleted_siblings):
+            output_path = relpath(sibling_path, output_dir)
+            if output_path in previous_siblings:
+                changes['removed'].append({'path': output_path,
+                                           'compressed': []})
+        return changes
+
+    def _load_manifest(self):
+        """
+        Loads the manifest of the last build and starts a new one. Returns
+        False if there is no usable manifest, in which case everything
+        has to be built from scratch.
+        """
+        path = join(self.settings['cache_dir'], 'manifest.pickle')
+        fingerprint = get_fingerprint(self.settings)
+        self.manifest = Manifest(path, fingerprint)
+        self.last_manifest = None
+        if self.output.persistent:
+            self.last_manifest = Manifest.load(path, fingerprint)
+        if self.last_manifest is None:
+            self.last_manifest = Manifest(path, fingerprint)
+            return False
+        return True
+
+    def _needs_walk(self):
+        """
+        Returns False if the project dir doesn't have to be walked again
+        because all changed files are known pages, static files or
+        templates. Updates the stat results of the changed files.
+        """
+        if self.changed is None or self._input_data is None:
+            return True
+        for path in self.changed:
+            if path.startswith(join(self.settings['template_dir'], '')):
+                continue
+            if path not in self._files:
+                return True
+            try:
+                self._stats[path] = os.stat(path)
+            except OSError:
+                return True
+            if not S_ISREG(self._stats[path].st_mode):
+                return True
+        return False
+
+    def run(self, changed=None):
+        """
+        Builds the site. `changed` is the set of paths that changed since
+        the last run. If given, the state of the last run is reused and
+        only the changed files are read again.
+        """
         start_time = time.time()
-        input_data = self._read_files()
+        if self._failed:
+            # the state of the failed run can't be reused
+            changed = None
+        self._failed = True
+        self.pages = []
+        self.static_files = []
+        self.changed = changed
+        # the output paths of this build whose content didn't change
+        self._unchanged = set()
+        # maps the output paths of this build to their source paths
+        self._sources = {}
+        # the compressed siblings written and deleted by _compress_output()
+        self._written_siblings = set()
+        self._deleted_siblings = set()
+        self.profiler = profiler = Profiler(self.settings.get('profile'))
+        if changed is not None and self.manifest is not None:
+            # rebuild: the manifest of the last run is still in memory
+            self.last_manifest = self.manifest
+            self.manifest = Manifest(self.last_manifest.path,
+                                     self.last_manifest.fingerprint)
+            incremental = True
+        else:
+            incremental = self.settings.get('incremental') and \
+                          self._load_manifest()
+
+        with profiler.phase('_read_files'):
+            if self._needs_walk():
+                self._input_data = self._read_files()
+                self._files = set()
+                for pages, static_files in self._input_data.itervalues():
+                    self._files.update(pages)
+                    self._files.update(static_files)
+        input_data = self._input_data
         logging.debug("input data %s", input_data)
-        self._parse(input_data)
-        self._sort()
-        self._delete_output_dir()
-        self._write()
-        self._copy_static_files()
+        with profiler.phase('_parse'):
+            self._parse(input_data)
+        with profiler.phase('_sort'):
+            self._sort()
+        try:
+            if not self.output.persistent:
+                # the server keeps serving the output of the last build
+                # until it's committed
+                self.output.begin()
+            if not incremental:
+                with profiler.phase('_prepare_output_dir'):
+                    self._prepare_output_dir()
+            with profiler.phase('_write'):
+                written = self._write()
+            with profiler.phase('_copy_static_files'):
+                written.extend(self._copy_static_files())
+            if self.output.persistent:
+                with profiler.phase('_compress_output'):
+                    self._compress_output(written)
+            with profiler.phase('commit'):
+                if self.manifest is not None:
+                    self._delete_vanished_files()
+                changes_path = self.settings.get('changes_path')
+                if changes_path and self.output.persistent:
+                    changes = self._get_changes(written)
+                self.output.commit()
+                if self.output.persistent and self.manifest is not None:
+                    self.manifest.save()
+                if changes_path and self.output.persistent:
+                    save_changes(changes_path, changes)
+        except:
+            # keep the output of the last build
+            self.output.abort()
+            raise
+        with profiler.phase('finish'):
+            if self.parse_cache is not None:
+                self.parse_cache.prune()
+            if self.fragment_cache is not None:
+                self.fragment_cache.prune()
+            if self.highlight_cache is not None:
+                self.highlight_cache.prune()
+        self._failed = False
         finish_time = time.time()
         count = len(self.pages)
-        print("OK (%s %s; %s seconds)" % (
-            count, 'page' if count == 1 else 'pages',
-            round(finish_time - start_time, 2)))
+        summary = "%s %s; %s seconds" % (
+                count, 'page' if count == 1 else 'pages',
+                round(finish_time - start_time, 2))
+        max_rss = get_max_rss()
+        if self.settings.get('stream') and max_rss is not None:
+            summary += "; peak memory %.1f MB" % (max_rss / 1048576.0)
+        print("OK (%s)" % summary)
+        if profiler.enabled:
+            print(profiler.get_report())
+            profiler.save_trace(self.settings['profile_path'])
+            logging.info('wrote trace to %s', self.settings['profile_path'])
+
+# the pages whose content was loaded in streaming mode, see _load_content()
+_loaded_pages = []
+
+def _load_content(content_store, parser_cls, settings, page):
+    """
+    Returns the content of `page` from the content store (the parse cache
+    or the temporary store of the streaming mode) or, if it isn't stored,
+    by parsing its source file again. In streaming mode the content is
+    released again by _render_page() after the current page was written.
+    """
+    if settings.get('stream'):
+        _loaded_pages.append(page)
+    if content_store is not None and page.content_key is not None:
+        parsed = content_store.get(page.content_key)
+        if parsed is not None:
+            return parsed[1]
+    logging.debug('parsing %s again', page.path)
+    path = join(settings['project_dir'], page.path)
+    with open(path, 'r', encoding='utf8') as f:
+        source = f.read()
+    return parser_cls(settings, source).parse()[1]
+
+# the state of the renderer in the current process, see _init_renderer()
+_renderer = None
+
+def _init_renderer(settings, pages, public_pages, site, url_for,
+                   fragment_cache, pages_hash, output):
+    """
+    Sets up the Jinja2 environment, pages, indexes and output for
+    _render_page()
+    """
+    global _renderer
+    _renderer = (Jinja2Template(settings, fragment_cache, pages_hash),
+                 settings, pages, public_pages, site, url_for, output)
+
+def _render_page(args):
+    """
+    Renders a page and writes it to the output. Takes a single
+    (index, output_path, listing) tuple, where `index` is the position of
+    the page in the pages passed to _init_renderer() and `listing` is None
+    or the (value, number, urls) tuple of a paginated listing page.
+
+    Returns an (error, templates, rendered, changed) tuple. `error` is
+    None on success or the TemplateException that was raised while
+    rendering, `templates` is the set of template names that were loaded.
+    If the output can't be written from this process, `rendered` is the
+    rendered page that the caller has to write, otherwise None and
+    `changed` tells whether the written file changed.
+    """
+    index, output_path, listing = args
+    template_cls, settings, pages, public_pages, site, url_for, output = \
+            _renderer
+    page = pages[index]
+    paginator = None
+    if listing is not None:
+        paginator = site.get_paginator(page, *listing)
+
+    # render template with Jinja2
+    if page['template'] == 'self':
+        render_func = template_cls.render_string
+        template = page['content']
+    else:
+        render_func = template_cls.render
+        template = page['template']
+
+    try:
+        rendered = render_func(template,
+                               page=page,
+                               pages=public_pages,
+                               site=site,
+                               paginator=paginator,
+                               url_for=url_for,
+                               settings=settings)
+    except TemplateException as error:
+        return error, template_cls.loaded_templates, None, False
+    finally:
+        # the content of most pages isn't needed after their own render
+        page.release_content()
+        if settings.get('stream'):
+            # e.g. the contents of all pages loaded by a feed template
+            while _loaded_pages:
+                _loaded_pages.pop().release_content()
+
+    if not output.shared:
+        return None, template_cls.loaded_templates, rendered, None
+    logging.debug("writing %s to %s", page['path'], output_path)
+    changed = output.write(output_path, rendered)
+    return None, template_cls.loaded_templates, None, changed
 
 def quickstart(settings):
     login = getlogin()
@@ -293,6 +1051,55 @@ def main():
                       help="sets the logging level. 'info' (default) or 'debug'")
     parser.add_option('--server', help='start a local webserver',
                       action="store_true", dest="server")
+    parser.add_option('--in-memory',
+                      help="with --server, keep the generated site in memory "
+                           "instead of writing it to _output and reload "
+                           "browsers after every rebuild",
+                      action="store_true", dest="in_memory")
+    parser.add_option('--address', default='',
+                      help="the address the webserver binds to "
+                           "(default: all interfaces)")
+    parser.add_option('--port', type='int', default=8000,
+                      help="the port the webserver listens on "
+                           "(default: 8000)")
+    parser.add_option('--incremental',
+                      help="only rebuild pages whose input has changed "
+                           "since the last build",
+                      action="store_true", dest="incremental")
+    parser.add_option('--no-cache',
+                      help="don't use the caches in _lib/.cache",
+                      action="store_true", dest="no_cache")
+    parser.add_option('--compile-templates',
+                      help="compile all templates into the template cache "
+                           "and exit",
+                      action="store_true", dest="compile_templates")
+    parser.add_option('--static-mode', default='copy',
+                      choices=('copy', 'hardlink', 'reflink'),
+                      help="how static files are put into the output dir: "
+                           "'copy' (default), 'hardlink' or 'reflink'")
+    parser.add_option('--compress',
+                      help="write gzip and brotli compressed copies of "
+                           "HTML, XML, CSS and JS files",
+                      action="store_true", dest="compress")
+    parser.add_option('--stream',
+                      help="keep the parsed pages on disk instead of in "
+                           "memory until they are written, to limit the "
+                           "memory use of big sites",
+                      action="store_true", dest="stream")
+    parser.add_option('--changes', metavar='FILE',
+                      help="write the output files that were added, "
+                           "changed or removed since the last build as "
+                           "JSON to FILE and as lists for rsync "
+                           "--files-from next to it",
+                      dest="changes")
+    parser.add_option('--profile',
+                      help="print the time taken by every build phase and "
+                           "the slowest pages and write a Chrome trace to "
+                           "_lib/.cache/profile.json",
+                      action="store_true", dest="profile")
+    parser.add_option('-j', '--jobs', type='int', default=1,
+                      help="number of worker processes used for parsing "
+                           "and rendering (default: 1)")
     options, args = parser.parse_args()
 
     try:
@@ -306,7 +1113,20 @@ def main():
                 'lib_dir': join(project_dir, '_lib'),
                 'url_path': join(project_dir, '_lib', 'urls.py'),
                 'settings_path': join(project_dir, '_lib', 'settings.cfg'),
-                'build_time': datetime.today()}
+                'cache_dir': join(project_dir, '_lib', '.cache'),
+                'build_time': datetime.today(),
+                'incremental': options.incremental or options.server,
+                'use_cache': not options.no_cache,
+                'watch': options.server,
+                'in_memory': options.server and options.in_memory,
+                'static_mode': options.static_mode,
+                'compress': options.compress,
+                'stream': options.stream,
+                'changes_path': options.changes and abspath(options.changes),
+                'profile': options.profile,
+                'profile_path': join(project_dir, '_lib', '.cache',
+                                     'profile.json'),
+                'jobs': options.jobs}
 
     # configure logging
     logging_level = LOGGING_LEVELS.get(options.logging, logging.INFO)
@@ -326,29 +1146,71 @@ def main():
         settings.update(dict(config.items('pyll')))
     logging.debug('settings %s', settings)
 
+    # compile templates
+    if options.compile_templates:
+        errors = Jinja2Template(settings).compile_templates()
+        for template_name, error in errors:
+            logging.error('couldn\'t compile template "%s": %s',
+                          template_name, error)
+        sys.exit(1 if errors else 0)
+
     # initialize site
     site = Site(settings)
 
-    def runserver(server_class=BaseHTTPServer.HTTPServer,
+    # builds run in the server thread and in the watcher thread
+    build_lock = threading.Lock()
+    notifier = ReloadNotifier()
+
+    def runserver(server_class=ThreadingHTTPServer,
                   handler_class=LanyonHTTPRequestHandler,
                   *args, **kwargs):
-        site.run()
+        build()
         handler_class.rootpath = settings['output_dir']
-        server_address = ('', 8000)
+        if settings['in_memory']:
+            handler_class.output = site.output
+            handler_class.notifier = notifier
+        server_address = (options.address, options.port)
         httpd = server_class(server_address, handler_class)
-        logging.info("serving at port %s", server_address[1])
+        logging.info("serving at %s:%s", server_address[0] or '*',
+                     server_address[1])
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
             sys.exit(0)
 
+    def build(changed=None):
+        "Builds the site and returns False if it failed"
+        with build_lock:
+            try:
+                site.run(changed)
+            except UrlException as error:
+                logging.error(error)
+                return False
+            except Exception:
+                # e.g. a template syntax error. the server keeps serving
+                # the output of the last build.
+                logging.exception('build failed')
+                return False
+        return True
+
+    def rebuild(changed):
+        logging.info('rebuilding (%s changed)', ', '.join(
+                relpath(path, settings['project_dir']) for path in changed))
+        if build(changed):
+            notifier.notify()
+
     if options.server:
+        # changes to the urls or settings file require a restart, all
+        # other changes are rebuilt in-process
         autoreload.main(runserver, (), {'paths': (
             settings['project_dir'],
             settings['template_dir'],
-            settings['lib_dir'])})
-    else:
-        site.run()
+            settings['lib_dir']),
+            'restart_paths': (settings['lib_dir'],),
+            'ignore': site.ignore,
+            'rebuild': rebuild})
+    elif not build():
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
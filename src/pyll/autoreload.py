@@ -28,11 +28,13 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import logging
 import os
+from os.path import basename, dirname, islink, relpath
 import sys
 import time
 
-from pyll.utils import walk_ignore
+from pyll.utils import scan, is_ignored
 
 try:
     import thread
@@ -48,50 +50,248 @@ except ImportError:
 
 RUN_RELOADER = True
 
+# seconds without further changes before a batch of changes is reported
+DEBOUNCE_DELAY = 0.2
+
 _win = (sys.platform == "win32")
 
-def get_mtimes(directory):
-    global _win
+def get_mtime(stat):
+    if _win:
+        return stat.st_mtime - stat.st_ctime
+    return stat.st_mtime
+
+def get_mtimes(directory, ignore=is_ignored):
     mtimes = {}
-    for root, dirs, files in walk_ignore(directory):
-        for filename in files:
-            filepath = os.path.join(root, filename)
-            stat = os.stat(filepath)
-            mtime = stat.st_mtime
-            if _win:
-                mtime -= stat.st_ctime
-            mtimes[filepath] = mtime
+    for root, dirs, files in scan(directory, ignore):
+        for filename, stat in files:
+            mtimes[os.path.join(root, filename)] = get_mtime(stat)
     return mtimes
 
+def get_changed_files(new_mtimes, initial_mtimes):
+    """
+    Compares `new_mtimes` with `initial_mtimes` and returns the set of
+    keys that are not in both dicts or whose values are not the same.
+    """
+    changed = set(f for f in new_mtimes
+                  if initial_mtimes.get(f) != new_mtimes[f])
+    changed.update(f for f in initial_mtimes if not f in new_mtimes)
+    return changed
+
 def files_changed(new_mtimes, initial_mtimes):
     """
     Compares `new_mtimes` with `initial_mtimes` and returns True if
     a key is not in both dicts or the value of a key is not the same.
     """
-    for f in new_mtimes:
-        if not f in initial_mtimes:
-            # new file
-            return True
-        elif initial_mtimes[f] != new_mtimes[f]:
-            # file modified
-            return True
-    for f in initial_mtimes:
-        if not f in new_mtimes:
-            # removed
-            return True
-    return False
+    return bool(get_changed_files(new_mtimes, initial_mtimes))
+
+def is_subpath(path, directory):
+    "Returns True if `path` is `directory` or inside of it"
+    return path == directory or path.startswith(directory.rstrip(os.sep) +
+                                                os.sep)
+
+class Watcher(object):
+    """
+    Watches the files below `paths`, ignoring the names `ignore` returns
+    a true value for. Subclasses implement _get_changes().
+    """
+    def __init__(self, paths, ignore=is_ignored):
+        self.paths = paths
+        self.ignore = ignore
+
+    def _get_changes(self, timeout):
+        """
+        Returns the set of paths that changed. Blocks until there is a
+        change or, if `timeout` is not None, for at most `timeout` seconds.
+        """
+        raise NotImplementedError
+
+    def wait(self):
+        """
+        Blocks until files change and returns the set of changed paths.
+        Bursts of changes, e.g. an editor saving several files, are
+        reported together once no change happened for DEBOUNCE_DELAY
+        seconds.
+        """
+        changed = self._get_changes(None)
+        while True:
+            more = self._get_changes(DEBOUNCE_DELAY)
+            if not more:
+                return changed
+            changed |= more
+
+class PollingWatcher(Watcher):
+    """
+    Detects changes by comparing the mtimes of all files every second.
+
+    The watched trees are only walked once. Later polls stat the known
+    files and directories and only list the directories whose mtime
+    changed, i.e. that had files added, removed or renamed.
+    """
+    interval = 1
+
+    def __init__(self, paths, ignore=is_ignored):
+        super(PollingWatcher, self).__init__(paths, ignore)
+        self.polled = time.time()
+        # map the watched files and directories to their mtime
+        self.mtimes = {}
+        self.dirs = {}
+        for path in self.paths:
+            self._scan(path)
+
+    def _scan(self, directory):
+        "Adds the files and directories below `directory`"
+        for root, dirs, files in scan(directory, self.ignore):
+            try:
+                self.dirs[root] = os.stat(root).st_mtime
+            except OSError:
+                continue
+            for filename, stat in files:
+                self.mtimes[os.path.join(root, filename)] = get_mtime(stat)
+
+    def _remove(self, directory):
+        "Removes `directory` and returns the files that were below it"
+        for path in [path for path in self.dirs
+                     if is_subpath(path, directory)]:
+            del self.dirs[path]
+        removed = set(path for path in self.mtimes
+                      if is_subpath(path, directory))
+        for path in removed:
+            del self.mtimes[path]
+        return removed
+
+    def _rescan(self, directory):
+        "Lists `directory` again and returns the files that changed in it"
+        try:
+            root, dirs, files = next(scan(directory, self.ignore))
+            self.dirs[directory] = os.stat(directory).st_mtime
+        except (StopIteration, OSError):
+            return self._remove(directory)
+        changed = set()
+        files = dict((os.path.join(directory, filename), get_mtime(stat))
+                     for filename, stat in files)
+        for path in [path for path in self.mtimes
+                     if dirname(path) == directory and path not in files]:
+            del self.mtimes[path]
+            changed.add(path)
+        for path, mtime in files.iteritems():
+            if self.mtimes.get(path) != mtime:
+                self.mtimes[path] = mtime
+                changed.add(path)
+        dirs = set(os.path.join(directory, name) for name in dirs)
+        for path in [path for path in self.dirs
+                     if dirname(path) == directory and path not in dirs]:
+            changed |= self._remove(path)
+        for path in dirs:
+            if path not in self.dirs and not islink(path):
+                known = set(self.mtimes)
+                self._scan(path)
+                changed.update(path for path in self.mtimes
+                               if path not in known)
+        return changed
+
+    def _poll(self):
+        "Returns the set of files that changed since the last poll"
+        changed = set()
+        polled, self.polled = self.polled, time.time()
+        for directory, mtime in sorted(self.dirs.items()):
+            if directory not in self.dirs:
+                # was below a removed directory
+                continue
+            try:
+                new_mtime = os.stat(directory).st_mtime
+            except OSError:
+                new_mtime = None
+            # on file systems with coarse mtimes a directory can change
+            # again without getting a new mtime right after it was listed
+            if new_mtime != mtime or mtime >= polled - 1:
+                changed |= self._rescan(directory)
+        for path, mtime in self.mtimes.items():
+            try:
+                new_mtime = get_mtime(os.stat(path))
+            except OSError:
+                del self.mtimes[path]
+                changed.add(path)
+                continue
+            if new_mtime != mtime:
+                self.mtimes[path] = new_mtime
+                changed.add(path)
+        return changed
+
+    def _get_changes(self, timeout):
+        while True:
+            time.sleep(self.interval if timeout is None else timeout)
+            changed = self._poll()
+            if changed or timeout is not None:
+                return changed
+
+class InotifyWatcher(Watcher):
+    "Detects changes with inotify events. Requires pyinotify."
+    def __init__(self, paths, ignore=is_ignored):
+        import pyinotify
+        super(InotifyWatcher, self).__init__(paths, ignore)
+        self.changed = set()
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.manager, self._add_event)
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | \
+               pyinotify.IN_DELETE | pyinotify.IN_MODIFY | \
+               pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+        for path in paths:
+            self.manager.add_watch(path, mask, rec=True, auto_add=True,
+                                   exclude_filter=self._is_excluded)
+
+    def _is_excluded(self, path):
+        return path not in self.paths and self.ignore(basename(path))
+
+    def _add_event(self, event):
+        for path in self.paths:
+            if is_subpath(event.pathname, path):
+                names = relpath(event.pathname, path).split(os.sep)
+                if not any(self.ignore(name) for name in names):
+                    self.changed.add(event.pathname)
+                    return
+
+    def _get_changes(self, timeout):
+        while not self.changed:
+            if self.notifier.check_events(
+                    None if timeout is None else int(timeout * 1000)):
+                self.notifier.read_events()
+                self.notifier.process_events()
+            elif timeout is not None:
+                break
+        changed, self.changed = self.changed, set()
+        return changed
+
+def get_watcher(paths, ignore=is_ignored):
+    "Returns an InotifyWatcher if pyinotify is available, else a PollingWatcher"
+    try:
+        return InotifyWatcher(paths, ignore)
+    except ImportError:
+        logging.debug('pyinotify not found, polling for changes')
+        return PollingWatcher(paths, ignore)
 
 def reloader_thread(args, kwargs):
-    initial_mtimes = {}
-    for mtimes in map(get_mtimes, kwargs['paths']):
-        initial_mtimes.update(mtimes)
+    """
+    Waits for changes below `kwargs['paths']`, except for the names
+    `ignore` returns a true value for. If a `rebuild` function is
+    given, it's called with the set of changed paths. Changes below
+    `restart_paths`, or any change without a `rebuild` function, restart
+    the process.
+    """
+    watcher = get_watcher(kwargs['paths'], kwargs.get('ignore', is_ignored))
+    rebuild = kwargs.get('rebuild')
+    restart_paths = kwargs.get('restart_paths', ())
     while RUN_RELOADER:
-        new_mtimes = {}
-        for mtimes in map(get_mtimes, kwargs['paths']):
-            new_mtimes.update(mtimes)
-        if files_changed(new_mtimes, initial_mtimes):
+        changed = watcher.wait()
+        logging.debug('changed files %s', changed)
+        if rebuild is None or any(is_subpath(path, restart_path)
+                                  for path in changed
+                                  for restart_path in restart_paths):
             sys.exit(3) # force reload
-        time.sleep(1)
+        try:
+            rebuild(changed)
+        except Exception:
+            # keep watching, the next change may fix the error
+            logging.exception('rebuild failed')
 
 def restart_with_reloader():
     while True:
@@ -0,0 +1,9 @@
+"""
+Benchmarks for pyll. sitegen generates synthetic projects of a given size
+and shape, runner builds them and measures the build, and
+
+    python -m pyll.benchmark --pages 1000,10000 --output results.json
+
+runs the builds from the command line. Pass `--baseline results.json` to
+compare a later run against stored results.
+"""
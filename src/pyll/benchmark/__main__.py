@@ -0,0 +1,112 @@
+import json
+import logging
+from optparse import OptionParser
+from os.path import join, abspath
+import platform
+import sys
+import tempfile
+
+from pyll import __version__
+from pyll.benchmark import runner
+from pyll.benchmark.sitegen import SiteGenerator
+
+def format_size(size):
+    if size is None:
+        return '-'
+    return '%.1f MB' % (size / 1048576.0)
+
+def main():
+    parser = OptionParser(usage="python -m pyll.benchmark [options]")
+    parser.add_option('--pages', default='1000',
+                      help="comma separated site sizes in pages "
+                           "(default: 1000)")
+    parser.add_option('--formats', default='md:0.6,rst:0.3,html:0.1',
+                      help="share of the page formats "
+                           "(default: md:0.6,rst:0.3,html:0.1)")
+    parser.add_option('--depth', type='int', default=2,
+                      help="nesting depth of the page directories "
+                           "(default: 2)")
+    parser.add_option('--static-dirs', type='int', default=10,
+                      help="number of static file directories (default: 10)")
+    parser.add_option('--scenarios', default='cold',
+                      help="comma separated build scenarios: %s "
+                           "(default: cold)" % ', '.join(runner.SCENARIOS))
+    parser.add_option('-j', '--jobs', type='int', default=1,
+                      help="number of worker processes (default: 1)")
+    parser.add_option('--repeat', type='int', default=3,
+                      help="builds per benchmark (default: 3)")
+    parser.add_option('--dir',
+                      default=join(tempfile.gettempdir(), 'pyll-benchmark'),
+                      help="where the generated sites are kept")
+    parser.add_option('-o', '--output',
+                      help="write the results as JSON to this file")
+    parser.add_option('-b', '--baseline',
+                      help="compare the results with this JSON file and "
+                           "exit with status 1 on regressions")
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help="relative slowdown or memory growth reported as "
+                           "a regression (default: 0.1)")
+    parser.add_option('-v', '--verbose', action='store_true',
+                      help="log the progress")
+    options, args = parser.parse_args()
+    logging.basicConfig(
+            level=logging.INFO if options.verbose else logging.WARNING,
+            format='%(asctime)s %(levelname)s: %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S')
+
+    formats = []
+    for item in options.formats.split(','):
+        ext, share = item.split(':')
+        formats.append((ext, float(share)))
+    scenarios = options.scenarios.split(',')
+    for scenario in scenarios:
+        if scenario not in runner.SCENARIOS:
+            parser.error('unknown scenario "%s"' % scenario)
+
+    results = {}
+    print('%-16s %8s %10s %10s %10s' % ('benchmark', 'pages', 'seconds',
+                                        'pages/s', 'peak'))
+    for pages in [int(count) for count in options.pages.split(',')]:
+        directory = abspath(join(options.dir, 'site-%d' % pages))
+        generator = SiteGenerator(directory, pages, formats,
+                                  depth=options.depth,
+                                  static_dirs=options.static_dirs)
+        if not generator.is_generated():
+            logging.info('generating %s', directory)
+        generator.generate()
+        for scenario in scenarios:
+            name = '%d/%s' % (pages, scenario)
+            result = runner.run(directory, scenario, options.jobs,
+                                options.repeat)
+            results[name] = result
+            print('%-16s %8d %10.2f %10.1f %10s' % (
+                    name, result['pages'], result['time'],
+                    result['pages_per_second'] or 0,
+                    format_size(result['max_rss'])))
+            for phase, duration in sorted(result['phases'].iteritems(),
+                                          key=lambda item: -item[1]):
+                print('    %-20s %10.3f' % (phase, duration))
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'pyll': __version__,
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'benchmarks': results}, f, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)['benchmarks']
+        regressions = runner.compare(results, baseline, options.threshold)
+        for name, metric, old, new in regressions:
+            if metric == 'max_rss':
+                old, new = format_size(old), format_size(new)
+            else:
+                old, new = '%.2fs' % old, '%.2fs' % new
+            print('REGRESSION %s %s: %s -> %s' % (name, metric, old, new))
+        if regressions:
+            sys.exit(1)
+        print('no regressions')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+from datetime import datetime
+import logging
+from multiprocessing import Process, Pipe
+import os
+from os.path import join
+import sys
+import time
+
+from pyll.profiler import get_max_rss
+
+# the build scenarios: `cold` builds without caches, `cached` builds again
+# with the caches of the previous build
+SCENARIOS = ('cold', 'cached')
+
+def get_settings(project_dir, jobs=1, use_cache=False):
+    "Returns the settings `pyll` would use to build `project_dir`"
+    return {'project_dir': project_dir,
+            'output_dir': join(project_dir, '_output'),
+            'template_dir': join(project_dir, '_templates'),
+            'lib_dir': join(project_dir, '_lib'),
+            'url_path': join(project_dir, '_lib', 'urls.py'),
+            'settings_path': join(project_dir, '_lib', 'settings.cfg'),
+            'cache_dir': join(project_dir, '_lib', '.cache'),
+            'build_time': datetime.today(),
+            'incremental': False,
+            'use_cache': use_cache,
+            'static_mode': 'copy',
+            'profile': True,
+            'profile_path': join(project_dir, '_lib', '.cache',
+                                 'profile.json'),
+            'jobs': jobs}
+
+def _build(settings, conn):
+    """
+    Builds the site in a child process and sends the build time, the
+    number of pages, the peak memory use and the phase durations to
+    `conn`.
+    """
+    from pyll.app import Site
+    # the dots and the profiler report
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        site = Site(settings)
+        start = time.time()
+        site.run()
+        conn.send({'time': time.time() - start,
+                   'pages': len(site.pages),
+                   'max_rss': get_max_rss(),
+                   'phases': dict((phase['name'],
+                                   phase['end'] - phase['start'])
+                                  for phase in site.profiler.phases)})
+    except Exception as error:
+        conn.send({'error': '%s: %s' % (type(error).__name__, error)})
+    finally:
+        conn.close()
+
+def build(settings):
+    """
+    Builds a site in a new process, so the peak memory use isn't
+    influenced by earlier builds, and returns the measurements.
+    """
+    parent_conn, child_conn = Pipe(duplex=False)
+    process = Process(target=_build, args=(settings, child_conn))
+    process.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = {'error': 'build process died'}
+    process.join()
+    if 'error' in result:
+        raise RuntimeError(result['error'])
+    return result
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def run(project_dir, scenario='cold', jobs=1, repeat=3):
+    """
+    Builds the site in `project_dir` `repeat` times and returns the
+    median build time, phase durations and peak memory use as a dict.
+    """
+    use_cache = scenario == 'cached'
+    settings = get_settings(project_dir, jobs, use_cache)
+    if use_cache:
+        logging.info('filling the caches of %s', project_dir)
+        build(settings)
+    runs = []
+    for number in range(repeat):
+        logging.info('building %s (%s, run %d of %d)', project_dir, scenario,
+                     number + 1, repeat)
+        runs.append(build(settings))
+    build_time = median([result['time'] for result in runs])
+    pages = runs[0]['pages']
+    max_rss = None
+    if runs[0]['max_rss'] is not None:
+        max_rss = max(result['max_rss'] for result in runs)
+    return {'pages': pages,
+            'jobs': jobs,
+            'time': build_time,
+            'pages_per_second': pages / build_time if build_time else None,
+            'max_rss': max_rss,
+            'phases': dict((name, median([result['phases'].get(name, 0)
+                                          for result in runs]))
+                           for name in runs[0]['phases']),
+            'runs': [result['time'] for result in runs]}
+
+def compare(results, baseline, threshold=0.1):
+    """
+    Compares the benchmark results `results` with `baseline` and returns
+    a list of (name, metric, baseline value, value) tuples for every build
+    time or peak memory use that grew by more than `threshold`.
+    """
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        if name not in baseline:
+            continue
+        for metric in ('time', 'max_rss'):
+            old = baseline[name].get(metric)
+            new = result.get(metric)
+            if old and new and new > old * (1 + threshold):
+                regressions.append((name, metric, old, new))
+    return regressions
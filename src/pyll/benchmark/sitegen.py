@@ -0,0 +1,195 @@
+from codecs import open
+from datetime import datetime, timedelta
+import json
+import os
+from os.path import join, dirname, exists
+from random import Random
+import shutil
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua enim '
+         'ad minim veniam quis nostrud exercitation ullamco laboris nisi '
+         'aliquip ex ea commodo consequat duis aute irure in reprehenderit '
+         'voluptate velit esse cillum fugiat nulla pariatur').split()
+TAGS = ('python', 'web', 'static', 'jinja', 'docs', 'speed', 'notes', 'misc')
+CODE = '''def fib(n):
+    a, b = 0, 1
+    for i in range(n):
+        a, b = b, a + b
+    return a'''
+
+DEFAULT_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head>
+  <title>{{ page.title }}</title>
+  <link rel="stylesheet" href="/static/0/style0.css" type="text/css" />
+</head>
+<body>
+  <div class="content">{% block content %}{{ page.content }}{% endblock %}</div>
+  <ul class="recent">
+  {% for post in pages[:10] %}
+    <li><a href="{{ post.url }}">{{ post.title }}</a></li>
+  {% endfor %}
+  </ul>
+</body>
+</html>
+'''
+
+POST_TEMPLATE = '''{% extends "default.html" %}
+{% block content %}
+<h1>{{ page.title }}</h1>
+<p class="meta">{{ page.date|datetimeformat("%B %d, %Y") }}
+  {% if page.tags %}&middot; {{ page.tags }}{% endif %}</p>
+{{ page.content }}
+{% endblock %}
+'''
+
+INDEX_PAGE = '''title: Index
+status: hidden
+template: self
+
+{% extends "default.html" %}
+{% block content %}
+<ul class="posts">
+{% for post in pages %}
+  <li>{{ post.date|datetimeformat("%d %b %Y") }}
+    <a href="{{ post.url }}">{{ post.title }}</a></li>
+{% endfor %}
+</ul>
+{% endblock %}
+'''
+
+# the marker file with the parameters the project was generated with
+PARAMS_FILE = join('_lib', 'benchmark.json')
+
+class SiteGenerator(object):
+    """
+    Generates a synthetic pyll project with `pages` pages below
+    `directory`. The output only depends on the arguments:
+
+    `formats` - maps file extensions ('md', 'rst', 'html') to their share
+    of the pages
+    `depth` - how deep the page directories are nested
+    `fanout` - the number of subdirectories of each page directory
+    `static_dirs` - the number of directories with static files
+    `static_files` - the number of files in each static directory
+    `paragraphs` - the number of paragraphs of a page
+    `code_ratio` - the share of pages with a highlighted code block
+    `seed` - the seed of the random number generator
+    """
+    def __init__(self, directory, pages=1000,
+                 formats=(('md', 0.6), ('rst', 0.3), ('html', 0.1)),
+                 depth=2, fanout=4, static_dirs=10, static_files=20,
+                 paragraphs=5, code_ratio=0.2, seed=0):
+        self.directory = directory
+        self.params = {'pages': pages, 'formats': dict(formats),
+                       'depth': depth, 'fanout': fanout,
+                       'static_dirs': static_dirs,
+                       'static_files': static_files,
+                       'paragraphs': paragraphs, 'code_ratio': code_ratio,
+                       'seed': seed}
+
+    def is_generated(self):
+        "Returns True if the project was generated with the same parameters"
+        try:
+            with open(join(self.directory, PARAMS_FILE), 'r',
+                      encoding='utf8') as f:
+                return json.load(f) == self.params
+        except (IOError, ValueError):
+            return False
+
+    def generate(self):
+        """
+        Writes the project, unless it was generated with the same
+        parameters before. Returns the project directory.
+        """
+        if self.is_generated():
+            return self.directory
+        if exists(self.directory):
+            shutil.rmtree(self.directory)
+        self.random = Random(self.params['seed'])
+        self._write('_templates/default.html', DEFAULT_TEMPLATE)
+        self._write('_templates/post.html', POST_TEMPLATE)
+        self._write('index.html', INDEX_PAGE)
+        self._write_static_files()
+        formats = self._get_formats()
+        dirs = self._get_page_dirs()
+        start = datetime(2010, 1, 1)
+        for number in range(self.params['pages']):
+            ext = formats[number % len(formats)]
+            date = start + timedelta(hours=number * 7)
+            path = join(dirs[number % len(dirs)], 'page%d.%s' % (number, ext))
+            self._write(path, self._get_page(number, ext, date))
+        # written last, so an interrupted run is generated again
+        self._write(PARAMS_FILE, json.dumps(self.params))
+        return self.directory
+
+    def _write(self, path, text):
+        path = join(self.directory, path)
+        try:
+            os.makedirs(dirname(path))
+        except OSError:
+            pass
+        with open(path, 'w', encoding='utf8') as f:
+            f.write(text)
+
+    def _get_formats(self):
+        "Returns a list of 100 extensions in the ratio of the formats"
+        formats = []
+        for ext, share in sorted(self.params['formats'].items()):
+            formats.extend([ext] * int(round(share * 100)))
+        self.random.shuffle(formats)
+        return formats
+
+    def _get_page_dirs(self):
+        "Returns the nested page directories"
+        dirs = ['']
+        for level in range(self.params['depth']):
+            dirs = [join(parent, 'section%d' % number)
+                    for parent in dirs
+                    for number in range(self.params['fanout'])]
+        return dirs
+
+    def _write_static_files(self):
+        for number in range(self.params['static_dirs']):
+            for file_number in range(self.params['static_files']):
+                ext = ('css', 'js', 'json')[file_number % 3]
+                name = 'style' if ext == 'css' else 'file'
+                self._write(join('static', str(number),
+                                 '%s%d.%s' % (name, file_number, ext)),
+                            self._get_words(2000) + '\n')
+
+    def _get_words(self, count):
+        return ' '.join(self.random.choice(WORDS) for i in range(count))
+
+    def _get_paragraphs(self):
+        return [self._get_words(self.random.randint(40, 120)).capitalize() +
+                '.' for i in range(self.params['paragraphs'])]
+
+    def _get_page(self, number, ext, date):
+        headers = ['title: %s %d' % (self._get_words(4).title(), number),
+                   'date: %s' % date.strftime('%Y-%m-%d %H:%M'),
+                   'tags: %s' % ', '.join(self.random.sample(TAGS, 2))]
+        if ext != 'html':
+            headers.append('template: post.html')
+        paragraphs = self._get_paragraphs()
+        code = self.random.random() < self.params['code_ratio']
+        if ext == 'md':
+            body = '\n\n'.join(
+                    ['## %s' % self._get_words(3).title()] + paragraphs +
+                    ['* %s\n* %s' % (self._get_words(5), self._get_words(5))])
+            if code:
+                body += '\n\n    :::python\n' + '\n'.join(
+                        '    ' + line for line in CODE.splitlines())
+        elif ext == 'rst':
+            title = self._get_words(3).title()
+            body = '\n\n'.join(
+                    [title + '\n' + '-' * len(title)] + paragraphs +
+                    ['- %s\n- %s' % (self._get_words(5), self._get_words(5))])
+            if code:
+                body += '\n\n.. sourcecode:: python\n\n' + '\n'.join(
+                        '   ' + line for line in CODE.splitlines())
+        else:
+            body = '\n'.join('<p>%s</p>' % paragraph
+                             for paragraph in paragraphs)
+        return '\n'.join(headers) + '\n\n' + body + '\n'
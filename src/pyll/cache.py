@@ -0,0 +1,84 @@
+import cPickle as pickle
+import logging
+import os
+from os.path import join, dirname
+
+class FileCache(object):
+    """
+    A persistent key/value store with one pickle file per key below
+    `directory`. Keys are hex digests.
+
+    Reading an entry marks it as recently used. If the entries take up
+    more than `max_size` bytes, prune() evicts the least recently
+    used ones.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.changed = False
+
+    def _get_path(self, key):
+        return join(self.directory, key[:2], key)
+
+    def get(self, key, default=None):
+        "Returns the value stored for `key` or `default`"
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError,
+                AttributeError, ImportError, ValueError):
+            return default
+        # the mtime marks when the entry was used last
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value):
+        "Stores `value` for `key`"
+        path = self._get_path(key)
+        try:
+            os.makedirs(dirname(path))
+        except OSError:
+            pass
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except (IOError, OSError, pickle.PicklingError) as error:
+            logging.debug('couldn\'t write cache entry "%s": %s', path, error)
+            return
+        self.changed = True
+
+    def prune(self):
+        """
+        Deletes the least recently used entries until all entries fit
+        into `max_size` bytes.
+        """
+        if not self.changed:
+            return
+        entries = []
+        total_size = 0
+        for root, dirs, files in os.walk(self.directory):
+            for filename in files:
+                path = join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_size += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            logging.debug('evicting cache entry %s', path)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+        self.changed = False
@@ -0,0 +1,69 @@
+import hashlib
+from os.path import splitext, exists
+import zlib
+
+from pyll.utils import get_tmp_path, replace_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# output files with these extensions get compressed siblings
+COMPRESS_EXTENSIONS = ('.html', '.htm', '.xml', '.css', '.js')
+
+def gzip_compress(data, level):
+    "Returns `data` in gzip format. The header contains no name or mtime."
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def brotli_compress(data, level):
+    return brotli.compress(data, quality=level)
+
+# a mapping of compression formats to the file extension of the
+# compressed sibling and the compression function
+formats = {
+    'gzip': ('.gz', gzip_compress),
+    'brotli': ('.br', brotli_compress),
+}
+
+def get_formats(names):
+    "Returns the available formats among `names`"
+    return [name for name in names
+            if name in formats and (name != 'brotli' or brotli is not None)]
+
+def is_compressible(path):
+    return splitext(path)[1].lower() in COMPRESS_EXTENSIONS
+
+def get_sibling_paths(path):
+    "Returns the paths of all possible compressed siblings of `path`"
+    return [path + extension for extension, func in formats.itervalues()]
+
+def compress_file(args):
+    """
+    Writes compressed siblings of a file, e.g. `index.html.gz` next to
+    `index.html`, unless the file didn't change since its siblings
+    were written.
+
+    Takes a single (path, last_hash, levels) tuple, so that it can be
+    mapped over a pool of worker processes. `last_hash` is the hash
+    returned for the file by the last call, `levels` maps format names to
+    compression levels. Returns the hash of the file and the list of the
+    extensions of the siblings that were written.
+    """
+    path, last_hash, levels = args
+    with open(path, 'rb') as f:
+        data = f.read()
+    data_hash = hashlib.sha1(data).hexdigest()
+    written = []
+    for name, level in levels.iteritems():
+        extension, func = formats[name]
+        sibling_path = path + extension
+        if data_hash == last_hash and exists(sibling_path):
+            continue
+        tmp_path = get_tmp_path(sibling_path)
+        with open(tmp_path, 'wb') as f:
+            f.write(func(data, level))
+        replace_file(tmp_path, sibling_path)
+        written.append(extension)
+    return data_hash, written
@@ -0,0 +1,58 @@
+from os.path import join
+
+from pyll.cache import FileCache
+from pyll.manifest import get_hash
+
+# the FileCache used by highlight(), see set_cache()
+_cache = None
+# the FileCache of every cache dir, see get_cache()
+_caches = {}
+
+def get_cache(settings):
+    """
+    Returns the FileCache of highlighted code blocks for `settings` or
+    None if caching is disabled. There is one per cache dir and process.
+    """
+    if not settings.get('use_cache') or 'cache_dir' not in settings:
+        return None
+    directory = join(settings['cache_dir'], 'highlight')
+    if directory not in _caches:
+        _caches[directory] = FileCache(
+                directory,
+                int(settings.get('highlight_cache_size', 32)) << 20)
+    return _caches[directory]
+
+def set_cache(settings):
+    "Makes highlight() use the cache for `settings`"
+    global _cache
+    _cache = get_cache(settings)
+
+def get_key(code, lexer, formatter):
+    """
+    Returns the cache key for highlighting `code` with the Pygments
+    `lexer` and `formatter`.
+    """
+    import pygments
+    return get_hash(repr((
+            pygments.__version__,
+            type(lexer).__module__, type(lexer).__name__,
+            sorted(lexer.options.items()),
+            type(formatter).__module__, type(formatter).__name__,
+            sorted(formatter.options.items()),
+            get_hash(code))))
+
+def highlight(code, lexer, formatter, outfile=None):
+    """
+    Works like pygments.highlight(), but returns the highlighted code from
+    the cache if the same code was highlighted with the same lexer and
+    formatter options before.
+    """
+    from pygments import highlight as pygments_highlight
+    if _cache is None or outfile is not None:
+        return pygments_highlight(code, lexer, formatter, outfile)
+    key = get_key(code, lexer, formatter)
+    highlighted = _cache.get(key)
+    if highlighted is None:
+        highlighted = pygments_highlight(code, lexer, formatter)
+        _cache.set(key, highlighted)
+    return highlighted
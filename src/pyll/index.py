@@ -0,0 +1,193 @@
+import logging
+import re
+from os.path import splitext
+
+from pyll.manifest import get_hash
+from pyll.utils import OrderedDict
+
+SLUG_RE = re.compile(r'[^\w]+', re.UNICODE)
+
+def slugify(value):
+    "Returns `value` in lowercase with runs of non-word characters as '-'"
+    return SLUG_RE.sub('-', unicode(value).lower()).strip('-')
+
+def get_url_dir(url):
+    "Returns the directory url below which the listings of `url` are put"
+    if url.endswith('/'):
+        return url
+    return splitext(url)[0] + '/'
+
+
+class UrlIndex(object):
+    """
+    Maps the urls of all pages of a build to the pages and the source
+    paths of the pages to their urls. Templates call it as `url_for(path)`
+    with the path of a page relative to the project dir.
+    """
+    def __init__(self, pages):
+        self.by_url = dict((page['url'], page) for page in pages)
+        self.by_path = dict((page['path'], page['url']) for page in pages)
+        self._hash = None
+
+    def __call__(self, path):
+        "Returns the url of the page `path` or None if there is none"
+        url = self.by_path.get(path)
+        if url is None:
+            logging.warning('url_for: no page "%s"', path)
+        return url
+
+    def get_hash(self):
+        "Returns a hash over the paths and urls of all pages"
+        if self._hash is None:
+            self._hash = get_hash(repr(sorted(self.by_path.iteritems())))
+        return self._hash
+
+    def __repr__(self):
+        # identifies the urls in fragment cache keys
+        return '<UrlIndex %s>' % self.get_hash()
+
+class SiteIndex(object):
+    """
+    Indexes of the public pages of a build, which are computed once per
+    build and passed to templates as `site`.
+
+    `pages` - the pages, newest first
+    `by_url` - maps urls to pages
+    `years` - maps years to their pages, newest year first
+    `months` - maps (year, month) tuples to their pages, newest first
+
+    The values of the headers in `list_headers` (e.g. tags) are split at
+    commas by by().
+    """
+    def __init__(self, pages, list_headers=('tags',)):
+        self.pages = pages
+        self.list_headers = list_headers
+        self.by_url = dict((page['url'], page) for page in pages)
+        self.years = OrderedDict()
+        self.months = OrderedDict()
+        for page in pages:
+            date = page['date']
+            self.years.setdefault(date.year, []).append(page)
+            self.months.setdefault((date.year, date.month), []).append(page)
+        self._positions = dict((id(page), pos)
+                               for pos, page in enumerate(pages))
+        self._by = {}
+        self._sorted = {}
+
+    def by(self, header):
+        """
+        Returns an OrderedDict that maps the values of `header`, sorted,
+        to the pages (newest first) with that value.
+        """
+        if header not in self._by:
+            values = {}
+            for page in self.pages:
+                for value in self._get_values(page, header):
+                    values.setdefault(value, []).append(page)
+            self._by[header] = OrderedDict(sorted(values.iteritems()))
+        return self._by[header]
+
+    def _get_values(self, page, header):
+        value = page.get(header)
+        if value is None:
+            return []
+        if isinstance(value, (list, tuple, set)):
+            return value
+        if header in self.list_headers and isinstance(value, basestring):
+            return [item.strip() for item in value.split(',')
+                    if item.strip()]
+        return [value]
+
+    def sorted_by(self, key, reverse=False):
+        "Returns the pages sorted by the header `key`"
+        if (key, reverse) not in self._sorted:
+            self._sorted[key, reverse] = sorted(
+                    self.pages, key=lambda page: page.get(key),
+                    reverse=reverse)
+        return self._sorted[key, reverse]
+
+    def previous(self, page):
+        "Returns the page published before `page` or None"
+        pos = self._positions.get(id(page))
+        if pos is None or pos + 1 >= len(self.pages):
+            return None
+        return self.pages[pos + 1]
+
+    def next(self, page):
+        "Returns the page published after `page` or None"
+        pos = self._positions.get(id(page))
+        if not pos:
+            return None
+        return self.pages[pos - 1]
+
+    def get_listings(self, page):
+        """
+        Returns the listings of a page with a `paginate` header as a list
+        of (value, urls) tuples, where `urls` has one url per listing page.
+
+        Without a `paginate_by` header the page lists all pages itself.
+        With it, there is one listing below the url of the page for every
+        value of that header (e.g. `tags/python/`), and `value` is that
+        value. Listing pages after the first are put at `page/<n>/` below
+        the url of the listing.
+        """
+        try:
+            per_page = int(page['paginate'])
+        except (KeyError, ValueError):
+            return []
+        header = page.get('paginate_by')
+        if header:
+            listings = [(value, get_url_dir(page['url']) + slugify(value) +
+                         '/', len(pages))
+                        for value, pages in self.by(header).iteritems()]
+        else:
+            listings = [(None, page['url'], len(self.pages))]
+
+        result = []
+        for value, url, count in listings:
+            num_pages = max(1, -(-count // max(per_page, 1)))
+            urls = [url] + ['%spage/%d/' % (get_url_dir(url), number)
+                            for number in range(2, num_pages + 1)]
+            result.append((value, urls))
+        return result
+
+    def get_paginator(self, page, value, number, urls):
+        "Returns the Paginator for a listing page of `page`"
+        if value is None:
+            pages = self.pages
+        else:
+            pages = self.by(page['paginate_by'])[value]
+        return Paginator(pages, int(page['paginate']), number, urls, value)
+
+
+class Paginator(object):
+    """
+    One page of a paginated listing, passed to templates as `paginator`.
+
+    `pages` - the pages shown on this listing page
+    `number` - the number of this listing page, starting at 1
+    `num_pages` - the number of listing pages
+    `urls` - the urls of all listing pages
+    `value` - the header value the listing is for, or None
+    """
+    def __init__(self, pages, per_page, number, urls, value=None):
+        per_page = max(per_page, 1)
+        self.pages = pages[(number - 1) * per_page:number * per_page]
+        self.number = number
+        self.num_pages = len(urls)
+        self.urls = urls
+        self.value = value
+
+    def __repr__(self):
+        return '<Paginator %r %d/%d>' % (self.value, self.number,
+                                         self.num_pages)
+
+    @property
+    def previous_url(self):
+        if self.number > 1:
+            return self.urls[self.number - 2]
+
+    @property
+    def next_url(self):
+        if self.number < self.num_pages:
+            return self.urls[self.number]
@@ -0,0 +1,151 @@
+import cPickle as pickle
+import hashlib
+import json
+import logging
+import os
+from os.path import dirname, splitext
+
+from pyll import __version__
+
+# incremented whenever the attributes of Manifest change
+MANIFEST_VERSION = 6
+
+def get_hash(data, algorithm='sha1'):
+    "Returns the hash of the string `data`."
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    m = hashlib.new(algorithm)
+    m.update(data)
+    return m.hexdigest()
+
+def get_page_hash(page, content=True):
+    """
+    Returns a hash over all values of the page. Two pages with the same
+    hash render the same output for the same templates. The content is
+    represented by the page's `content_key`, so it isn't loaded. Without
+    `content` only the headers are hashed.
+    """
+    items = [(key, page[key]) for key in page.keys() if key != 'content']
+    return get_hash(repr((sorted(items),
+                          page.content_key if content else None)))
+
+
+class Manifest(object):
+    """
+    The state of the last build.
+
+    `fingerprint` - hash over the pyll and manifest version, settings file
+                    and urls file. A manifest with a different fingerprint
+                    is discarded.
+    `pages_hash` - hash over the headers of the public pages passed to
+                   templates
+    `contents_hash` - hash over the content of the public pages
+    `urls_hash` - hash over the urls of all pages, see UrlIndex
+    `pages` - maps the relative source path of a page to a dict with the
+              keys `source_hash`, `parser`, `headers`, `template`,
+              `output_path`, `listing_paths` (the output paths of its
+              paginated listings), `render_hash`, `uses_pages`,
+              `uses_contents` (whether its template reads the content of
+              other pages), `uses_urls` and `templates`, the names of all
+              templates loaded while rendering the page
+    `template_hashes` - maps template names to the hash of their source
+    `static_files` - maps the output path of a copied static file
+                     to its source path
+    `compressed` - maps output paths to the hash of the content their
+                   compressed siblings were created from
+    `compress_formats` - the names of the formats of the siblings
+    """
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.pages_hash = None
+        self.contents_hash = None
+        self.urls_hash = None
+        self.pages = {}
+        self.template_hashes = {}
+        self.static_files = {}
+        self.compressed = {}
+        self.compress_formats = []
+
+    @classmethod
+    def load(cls, path, fingerprint):
+        """
+        Loads the manifest from `path`. Returns None if the file doesn't
+        exist, can't be read or belongs to a different fingerprint.
+        """
+        try:
+            with open(path, 'rb') as f:
+                manifest = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError,
+                AttributeError, ImportError) as error:
+            logging.debug('couldn\'t load manifest "%s": %s', path, error)
+            return
+        if manifest.fingerprint != fingerprint:
+            logging.debug('manifest "%s" is outdated', path)
+            return
+        manifest.path = path
+        return manifest
+
+    def save(self):
+        "Writes the manifest to disk"
+        try:
+            os.makedirs(dirname(self.path))
+        except OSError:
+            pass
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.path)
+
+    def get_output_paths(self):
+        "Returns the set of all output paths written by the build"
+        paths = set(entry['output_path'] for entry in self.pages.itervalues()
+                    if entry.get('output_path'))
+        for entry in self.pages.itervalues():
+            paths.update(entry.get('listing_paths', ()))
+        paths.update(self.static_files)
+        return paths
+
+
+def get_fingerprint(settings):
+    """
+    Returns a hash over everything that affects all pages at once: the
+    pyll and manifest version, the settings file and the urls file.
+    """
+    parts = [__version__, str(MANIFEST_VERSION)]
+    for path in (settings['settings_path'], settings['url_path']):
+        try:
+            with open(path, 'rb') as f:
+                parts.append(f.read())
+        except IOError:
+            parts.append('')
+    return get_hash('\0'.join(parts))
+
+
+# the kinds of changes in the change manifest, see save_changes()
+CHANGE_KINDS = ('added', 'changed', 'removed')
+
+def save_changes(path, changes):
+    """
+    Writes the change manifest of a build to `path`. `changes` maps
+    'added', 'changed' and 'removed' to lists of dicts with the output
+    `path` relative to the output dir, the `compressed` siblings of the
+    file and, for written files, the sha1 `hash` of the content and the
+    `source` path of the page or static file.
+
+    The paths of each kind of change, including the compressed siblings,
+    are also written to text files next to `path`, one per line, e.g.
+    `changes.added.txt` for `changes.json`. They can be passed to
+    `rsync --files-from`.
+    """
+    try:
+        os.makedirs(dirname(path))
+    except OSError:
+        pass
+    with open(path, 'w') as f:
+        json.dump(changes, f, indent=2, sort_keys=True)
+    for kind in CHANGE_KINDS:
+        with open('%s.%s.txt' % (splitext(path)[0], kind), 'w') as f:
+            for entry in changes[kind]:
+                for output_path in [entry['path']] + entry['compressed']:
+                    f.write(output_path.encode('utf-8') + '\n')
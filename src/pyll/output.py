@@ -0,0 +1,291 @@
+from glob import glob
+import os
+from os.path import basename, dirname, exists, islink, lexists, realpath
+from shutil import rmtree, copy2
+import time
+
+from pyll.utils import copy_files, get_tmp_path, replace_file
+
+def _makedirs(path):
+    "Creates the parent directories of `path`"
+    try:
+        os.makedirs(dirname(path))
+    except OSError:
+        pass
+
+def _has_content(path, data):
+    "Returns True if the file `path` contains the byte string `data`"
+    try:
+        if os.stat(path).st_size != len(data):
+            return False
+        with open(path, 'rb') as f:
+            return f.read() == data
+    except (IOError, OSError):
+        return False
+
+class OutputDir(object):
+    """
+    Writes the generated site to the output directory `path`.
+
+    Worker processes can write to it directly (`shared`) and it keeps
+    its contents between runs of pyll (`persistent`).
+
+    Static files are copied by `copy_threads` threads; `static_mode` is
+    passed on to copy_file().
+
+    Files are only written if their content changed, so the others keep
+    their mtime. After begin() the files are written to a staging
+    directory next to `path` instead, which replaces `path` in commit().
+    Unchanged files are hardlinked into it from `path`. The methods
+    still take the paths below `path`.
+
+    Where symlinks are supported, `path` is a symlink to the directory
+    of the last build (`<path>.build-<time>-<pid>`), which commit()
+    replaces atomically, so `path` always points to a complete build.
+    """
+    shared = True
+    persistent = True
+
+    def __init__(self, path, static_mode='copy', copy_threads=1):
+        self.path = path
+        self.static_mode = static_mode
+        self.copy_threads = copy_threads
+        self.stage_path = None
+
+    def get_path(self, output_path):
+        "Returns where `output_path` is written to"
+        if self.stage_path is None:
+            return output_path
+        return self.stage_path + output_path[len(self.path):]
+
+    def begin(self):
+        "Starts writing to an empty staging directory"
+        self.abort()
+        self._clean_up()
+        self.stage_path = '%s.build-%d-%d.tmp' % (
+                self.path, time.time() * 1000, os.getpid())
+        os.makedirs(self.stage_path)
+
+    def _clean_up(self):
+        """
+        Deletes the build directories left over by crashed builds. If the
+        output directory itself is missing, the last complete build is
+        put in its place.
+        """
+        leftovers = glob(self.path + '.build-*') + glob(self.path + '.*.old')
+        if not lexists(self.path):
+            builds = sorted((path for path in leftovers
+                             if not path.endswith('.tmp') and
+                                not islink(path)),
+                            key=os.path.getmtime)
+            if builds:
+                self._replace(builds[-1])
+        current = realpath(self.path)
+        for path in leftovers:
+            if islink(path):
+                # a symlink that wasn't moved into place
+                os.remove(path)
+            elif realpath(path) != current:
+                rmtree(path, True)
+
+    def _replace(self, build_path):
+        "Makes the complete build in `build_path` the output directory"
+        if not hasattr(os, 'symlink'):
+            # e.g. windows, the output directory is replaced by renames
+            old_path = '%s.%d.old' % (self.path, os.getpid())
+            if exists(self.path):
+                os.rename(self.path, old_path)
+            os.rename(build_path, self.path)
+            if exists(old_path):
+                rmtree(old_path)
+            return
+        if exists(self.path) and not islink(self.path):
+            # the output directory of an older version of pyll, which
+            # can't be replaced by a symlink in one step
+            os.rename(self.path, '%s.build-0-%d' % (self.path, os.getpid()))
+        link_path = build_path + '.link'
+        if lexists(link_path):
+            os.remove(link_path)
+        os.symlink(basename(build_path), link_path)
+        os.rename(link_path, self.path)
+
+    def commit(self):
+        "Replaces the output directory with the staging directory"
+        if self.stage_path is None:
+            return
+        # without the .tmp suffix the build counts as complete
+        build_path = self.stage_path[:-len('.tmp')]
+        os.rename(self.stage_path, build_path)
+        self.stage_path = None
+        self._replace(build_path)
+        # the build that was replaced
+        self._clean_up()
+
+    def abort(self):
+        "Deletes the staging directory and keeps the output directory"
+        if self.stage_path is not None:
+            rmtree(self.stage_path, True)
+            self.stage_path = None
+
+    def keep(self, output_path):
+        """
+        Makes the file `output_path` of the output directory part of the
+        staged output. Returns False if it doesn't exist.
+        """
+        if self.stage_path is None:
+            return exists(output_path)
+        path = self.get_path(output_path)
+        if exists(path):
+            return True
+        _makedirs(path)
+        try:
+            os.link(output_path, path)
+        except OSError:
+            # e.g. the file system doesn't support hardlinks
+            try:
+                copy2(output_path, path)
+            except (IOError, OSError):
+                return False
+        return True
+
+    def write(self, output_path, content):
+        """
+        Writes the unicode string `content` to `output_path`. Returns
+        False if the file already had that content.
+        """
+        data = content.encode('utf-8')
+        if _has_content(output_path, data) and self.keep(output_path):
+            return False
+        path = self.get_path(output_path)
+        _makedirs(path)
+        # written next to the file and renamed, so that a webserver never
+        # serves a partial file. the rename also never writes through a
+        # hardlink into the output directory.
+        tmp_path = get_tmp_path(path)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        replace_file(tmp_path, path)
+        return True
+
+    def copy_files(self, files, stats=None):
+        """
+        Copies the static files in the list of (src, dst) tuples `files`.
+        `stats` maps source paths to their stat result. Returns the
+        destination paths that were copied, not the unchanged ones.
+        """
+        if self.stage_path is not None:
+            # copy_file() compares the files in the output directory
+            # with their source and replaces the changed ones
+            for src, dst in files:
+                self.keep(dst)
+        copied = copy_files([(src, self.get_path(dst)) for src, dst in files],
+                            self.static_mode, self.copy_threads, stats)
+        return [dst for (src, dst), was_copied in zip(files, copied)
+                if was_copied]
+
+    def exists(self, output_path):
+        return exists(self.get_path(output_path))
+
+    def remove(self, output_path):
+        """
+        Deletes `output_path` and the parent directories that became
+        empty by doing so.
+        """
+        path = self.get_path(output_path)
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        parent_dir = dirname(path)
+        while parent_dir not in (self.path, self.stage_path):
+            try:
+                os.rmdir(parent_dir)
+            except OSError:
+                # directory isn't empty
+                break
+            parent_dir = dirname(parent_dir)
+
+    def clear(self):
+        "Deletes the output directory"
+        if islink(self.path):
+            rmtree(realpath(self.path), True)
+            os.remove(self.path)
+        elif exists(self.path):
+            rmtree(self.path)
+
+class MemoryOutput(object):
+    """
+    Keeps rendered pages in memory and references static files by their
+    source path, so that the development server can serve the site
+    without writing to disk.
+
+    `files` maps output paths to (data, mtime, src) tuples: pages have
+    their UTF-8 encoded `data` and the time they were written, static
+    files the path `src` of their source file. The entries are replaced
+    as a whole, so the threads of the server never see half of a change.
+
+    After begin() a build changes a copy of `files` and `dirs`, while
+    get() and isdir() still return the output of the last build. commit()
+    replaces that output with the copy in one step, abort() drops it.
+    """
+    shared = False
+    persistent = False
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.dirs = set()
+        # the (files, dirs) tuple of the output that is served
+        self._served = (self.files, self.dirs)
+
+    def begin(self):
+        "Starts a build on a copy of the served output"
+        self.files = dict(self._served[0])
+        self.dirs = set(self._served[1])
+
+    def commit(self):
+        "Serves the output of the build"
+        self._served = (self.files, self.dirs)
+
+    def abort(self):
+        "Drops the output of the build and keeps serving the last one"
+        self.files, self.dirs = self._served
+
+    def _add_dirs(self, output_path):
+        parent_dir = dirname(output_path)
+        while parent_dir not in self.dirs and parent_dir != self.path:
+            self.dirs.add(parent_dir)
+            parent_dir = dirname(parent_dir)
+
+    def get(self, output_path):
+        "Returns the served (data, mtime, src) tuple of `output_path` or None"
+        return self._served[0].get(output_path)
+
+    def write(self, output_path, content):
+        data = content.encode('utf-8')
+        entry = self.files.get(output_path)
+        if entry is not None and entry[0] == data:
+            return False
+        self._add_dirs(output_path)
+        self.files[output_path] = (data, time.time(), None)
+        return True
+
+    def copy_files(self, files, stats=None):
+        for src, dst in files:
+            self._add_dirs(dst)
+            self.files[dst] = (None, None, src)
+        return [dst for src, dst in files]
+
+    def exists(self, output_path):
+        return output_path in self.files
+
+    def isdir(self, output_path):
+        return output_path == self.path or output_path in self._served[1]
+
+    def remove(self, output_path):
+        self.files.pop(output_path, None)
+
+    def clear(self):
+        # new objects, the served ones may be the same
+        self.files = {}
+        self.dirs = set()
@@ -0,0 +1,92 @@
+class Page(object):
+    """
+    A parsed page. The headers every page has are stored in slots, all
+    other headers in the `headers` dict. Both can be accessed like the
+    items of a dict, so templates and url rules can use `page.title`,
+    `page['title']` and `page.custom_header` alike.
+
+    `content` is loaded on first access by calling `content_loader` with
+    the page, unless it was set directly. release_content() drops it
+    again if it can be loaded later. `content_key` identifies the content
+    without loading it.
+    """
+    FIELDS = ('path', 'title', 'date', 'status', 'slug', 'template', 'url',
+              'output_ext', 'static_files')
+    __slots__ = FIELDS + ('headers', 'content_key', 'content_loader',
+                          '_content')
+
+    def __init__(self, **values):
+        for field in self.FIELDS:
+            setattr(self, field, None)
+        self.headers = {}
+        self.content_key = None
+        self.content_loader = None
+        self._content = None
+        self.update(values)
+
+    @property
+    def content(self):
+        if self._content is None and self.content_loader is not None:
+            self._content = self.content_loader(self)
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+
+    def release_content(self):
+        "Frees the memory used by the content if it can be loaded again"
+        if self.content_loader is not None:
+            self._content = None
+
+    def __getitem__(self, key):
+        if key in self.FIELDS or key == 'content':
+            return getattr(self, key)
+        return self.headers[key]
+
+    def __setitem__(self, key, value):
+        if key in self.FIELDS or key == 'content':
+            setattr(self, key, value)
+        else:
+            self.headers[key] = value
+
+    def __contains__(self, key):
+        return key in self.FIELDS or key == 'content' or key in self.headers
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getattr__(self, name):
+        # only called for names that aren't set slots or methods
+        if name == 'headers':
+            raise AttributeError(name)
+        try:
+            return self.headers[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return '<Page %r>' % self.path
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self.FIELDS) + ['content'] + self.headers.keys()
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def update(self, values=(), **kwargs):
+        for key, value in dict(values, **kwargs).iteritems():
+            self[key] = value
@@ -1,9 +1,76 @@
+from calendar import timegm
+import codecs
+from copy import copy
 import datetime
+import logging
 import re
 from os.path import splitext
 
 from dateutil import parser
 
+from pyll import __version__, highlight
+
+META_RE = re.compile(r'^[ ]{0,3}(?P<key>[A-Za-z0-9_-]+):\s*(?P<value>.*)')
+# ISO-8601 dates like "2012-05-01", "2012-05-01 14:30" or
+# "2012-05-01T14:30:00.5+02:00"
+DATE_RE = re.compile(r'^(\d{4})-(\d\d)-(\d\d)'
+                     r'(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6}))?)?)?'
+                     r'\s*(?:(Z)|([+-])(\d\d):?(\d\d))?$')
+
+# maps date header values to the datetime objects parsed by parse_date()
+_dates = {}
+
+def to_local(date, offset):
+    """
+    Converts `date` at the UTC offset `offset` (a timedelta) to a naive
+    datetime in the local timezone, like the dates from file ctimes.
+    """
+    timestamp = timegm((date - offset).timetuple())
+    return datetime.datetime.fromtimestamp(timestamp).replace(
+            microsecond=date.microsecond)
+
+def _parse_iso_date(value):
+    "Parses `value` if it matches DATE_RE, otherwise returns None"
+    match = DATE_RE.match(value)
+    if match is None:
+        return None
+    (year, month, day, hour, minute, second, fraction,
+     utc, sign, offset_hours, offset_minutes) = match.groups()
+    try:
+        date = datetime.datetime(
+                int(year), int(month), int(day), int(hour or 0),
+                int(minute or 0), int(second or 0),
+                int((fraction or '0').ljust(6, '0')))
+    except ValueError:
+        # e.g. "2012-02-30", let dateutil report it
+        return None
+    if utc:
+        return to_local(date, datetime.timedelta())
+    if sign:
+        offset = datetime.timedelta(hours=int(offset_hours),
+                                    minutes=int(offset_minutes))
+        return to_local(date, offset if sign == '+' else -offset)
+    return date
+
+def parse_date(value):
+    """
+    Parses the date string `value` into a naive datetime object in local
+    time. ISO-8601 dates are parsed directly, everything else by
+    dateutil. Dates with a timezone are converted to local time, so all
+    page dates can be compared with each other and datetime.today().
+    Raises ValueError if `value` isn't a date.
+    """
+    try:
+        return _dates[value]
+    except KeyError:
+        pass
+    date = _parse_iso_date(value)
+    if date is None:
+        date = parser.parse(value)
+        if date.tzinfo is not None:
+            date = to_local(date.replace(tzinfo=None), date.utcoffset())
+    _dates[value] = date
+    return date
 
 class ParserException(Exception):
     """Exception raised for errors during the parsing."""
@@ -18,25 +85,31 @@ class Parser(object):
         self.headers = {}
         self.text = ''
 
+    def _parse_header(self, match):
+        """
+        Adds the header matched by META_RE to the headers. Returns False
+        if the header has no value.
+        """
+        key = match.group('key').strip().lower()
+        value = match.group('value').strip()
+        if not value:
+            return False
+        # custom header transformation
+        header_method = getattr(self, '_parse_%s_header' % key, None)
+        if header_method:
+            value = header_method(value)
+        self.headers[key] = value
+        return True
+
     def _parse_headers(self):
         """
         Parses and removes the headers from the source.
         """
-        META_RE = re.compile(
-            r'^[ ]{0,3}(?P<key>[A-Za-z0-9_-]+):\s*(?P<value>.*)')
         lines = self.source.splitlines()
         for num, line in enumerate(lines):
             match = META_RE.match(line)
             if match:
-                key = match.group('key').strip().lower()
-                value = match.group('value').strip()
-                if value:
-                    # custom header transformation
-                    header_method = getattr(self, '_parse_%s_header' % key,
-                                            None)
-                    if header_method:
-                        value = header_method(value)
-                    self.headers[key] = value
+                if self._parse_header(match):
                     num_last_match = num
             else:
                 break
@@ -54,12 +127,25 @@ class Parser(object):
             pass
         self.text = '\n'.join(lines)
 
+    def read_headers(self, lines):
+        """
+        Parses the headers from the iterable `lines` and returns them.
+        `lines` is consumed only up to the first line after the headers,
+        so a file object can be passed without reading the whole file.
+        """
+        for line in lines:
+            match = META_RE.match(line.rstrip('\r\n'))
+            if not match:
+                break
+            self._parse_header(match)
+        return self.headers
+
     def _parse_date_header(self, value):
         """
         Parses the date header string into a python datetime object.
         """
         try:
-            return parser.parse(value)
+            return parse_date(value)
         except ValueError as error:
             raise ParserException(error)
 
@@ -79,6 +165,15 @@ class Parser(object):
         """
         return self.text
 
+    @classmethod
+    def get_cache_key(cls, settings):
+        """
+        Returns a string that identifies the output of the parser. It must
+        change whenever the parser could return something different for
+        the same source, e.g. when the markup library is updated.
+        """
+        return '%s.%s %s' % (cls.__module__, cls.__name__, __version__)
+
     def parse(self):
         self._parse_headers()
         self._parse_text()
@@ -88,15 +183,16 @@ class Parser(object):
 class RstParser(Parser):
     """ReStructuredText Parser"""
     output_ext = 'html'
+    # the docutils settings, created once per process by _setup()
+    _docutils_settings = None
 
-    def pygments_directive(self, name, arguments, options, content, lineno,
+    def pygments_directive(name, arguments, options, content, lineno,
                            content_offset, block_text, state, state_machine):
         """
         Parse sourcecode using Pygments
 
         From http://bitbucket.org/birkenfeld/pygments-main/src/tip/external/rst-directive-old.py
         """
-        from pygments import highlight
         from pygments.formatters import HtmlFormatter
         from pygments.lexers import get_lexer_by_name, TextLexer
         from docutils import nodes
@@ -108,48 +204,108 @@ class RstParser(Parser):
             lexer = TextLexer()
         # take an arbitrary option if more than one is given
         formatter = HtmlFormatter(noclasses=False)
-        parsed = highlight(u'\n'.join(content), lexer, formatter)
+        parsed = highlight.highlight(u'\n'.join(content), lexer, formatter)
         return [nodes.raw('', parsed, format='html')]
     pygments_directive.arguments = (1, 0, 1)
     pygments_directive.content = 1
+    pygments_directive = staticmethod(pygments_directive)
 
-    def _parse_text(self):
+    @classmethod
+    def get_cache_key(cls, settings):
+        key = super(RstParser, cls).get_cache_key(settings)
+        try:
+            import docutils
+            key += ' docutils ' + docutils.__version__
+            import pygments
+            key += ' pygments ' + pygments.__version__
+        except ImportError:
+            pass
+        return key
+
+    @classmethod
+    def _setup(cls):
+        """
+        Imports docutils, registers the "sourcecode" directive and reads
+        the docutils settings. Only the first call in a process does that.
+        """
+        if cls._docutils_settings is not None:
+            return
         try:
-            from docutils.core import publish_parts
+            from docutils.frontend import OptionParser
+            from docutils.parsers.rst import Parser as DocutilsParser
             from docutils.parsers.rst import directives
+            from docutils.readers.standalone import Reader
+            from docutils.writers.html4css1 import Writer
         except ImportError:
             raise Exception("The Python docutils library isn't installed. " +
                             "Install with `pip install docutils`")
+        # if pygments is installed, register the "sourcecode" directive
+        try:
+            import pygments
+        except ImportError:
+            pass
         else:
-            # if pygments is installed, register the "sourcecode" directive
-            try:
-                import pygments
-            except ImportError:
-                pass
-            else:
-                directives.register_directive('sourcecode',
-                                              self.pygments_directive)
-            self.text = publish_parts(source=self.text,
-                                      settings_overrides={
-                                            "doctitle_xform": False,
-                                            "initial_header_level": 2
-                                      },
-                                      writer_name='html4css1')['fragment']
+            directives.register_directive('sourcecode',
+                                          cls.pygments_directive)
+        settings = OptionParser(
+                components=(DocutilsParser, Reader, Writer),
+                read_config_files=True).get_default_values()
+        settings.doctitle_xform = False
+        settings.initial_header_level = 2
+        cls._docutils_settings = settings
+
+    def _parse_text(self):
+        self._setup()
+        highlight.set_cache(self.settings)
+        from docutils.core import publish_parts
+        # docutils stores state of the document in the settings
+        self.text = publish_parts(source=self.text,
+                                  settings=copy(self._docutils_settings),
+                                  writer_name='html4css1')['fragment']
 
 
 class MarkdownParser(Parser):
     """Markdown Parser"""
     output_ext = 'html'
+    # the Markdown instance, created once per process by _get_converter()
+    _converter = None
 
-    def _parse_text(self):
+    @classmethod
+    def get_cache_key(cls, settings):
+        key = super(MarkdownParser, cls).get_cache_key(settings)
         try:
             import markdown
+            key += ' markdown ' + markdown.version
+            import pygments
+            key += ' pygments ' + pygments.__version__
         except ImportError:
-            raise Exception("The Python markdown library isn't installed. " +
-                            "Install with `pip install markdown`")
-        else:
-            self.text = markdown.markdown(self.text,
-                                          ['codehilite(css_class=highlight)'])
+            pass
+        return key
+
+    @classmethod
+    def _get_converter(cls):
+        "Returns the Markdown instance of this process"
+        if cls._converter is None:
+            try:
+                import markdown
+            except ImportError:
+                raise Exception("The Python markdown library isn't " +
+                                "installed. Install with " +
+                                "`pip install markdown`")
+            cls._converter = markdown.Markdown(
+                    extensions=['codehilite(css_class=highlight)'])
+            # highlight code blocks through the highlight cache
+            from markdown.extensions import codehilite
+            codehilite.highlight = highlight.highlight
+        return cls._converter
+
+    def _parse_text(self):
+        converter = self._get_converter()
+        highlight.set_cache(self.settings)
+        try:
+            self.text = converter.convert(self.text)
+        finally:
+            converter.reset()
 
 
 # a mapping of file extensions to the corresponding parser class
@@ -159,13 +315,84 @@ parser_map = (
     (('md', 'markdown'), MarkdownParser),
 )
 
+# maps file extensions to parser classes, see register_parser()
+parsers = {}
+
+def register_parser(extensions, parser_cls):
+    "Registers `parser_cls` for the file extensions `extensions`"
+    for ext in extensions:
+        parsers[ext] = parser_cls
+
+for extensions, parser_cls in parser_map:
+    register_parser(extensions, parser_cls)
+
+_entry_points_loaded = False
+
+def load_entry_points():
+    """
+    Registers the parsers of other packages. They are declared as entry
+    points of the group `pyll.parsers`, named after the file extension,
+    e.g. `textile = pyll_textile:TextileParser`. They don't replace
+    registered parsers.
+    """
+    global _entry_points_loaded
+    _entry_points_loaded = True
+    try:
+        import pkg_resources
+    except ImportError:
+        return
+    for entry_point in pkg_resources.iter_entry_points('pyll.parsers'):
+        try:
+            parsers.setdefault(entry_point.name, entry_point.load())
+        except (ImportError, pkg_resources.ResolutionError) as error:
+            logging.error('couldn\'t load parser "%s": %s', entry_point,
+                          error)
+
+
+def parse_source(args):
+    """
+    Parses a source and returns the (headers, text) tuple, or the
+    ParserException raised while parsing.
+
+    Takes a single (parser_cls, settings, source) tuple, so that it can be
+    mapped over a pool of worker processes.
+    """
+    parser_cls, settings, source = args
+    try:
+        return parser_cls(settings, source).parse()
+    except ParserException as error:
+        return error
+
+
+def parse_file(args):
+    """
+    Like parse_source(), but takes a (parser_cls, settings, path) tuple and
+    reads the source from the file `path`.
+    """
+    parser_cls, settings, path = args
+    with codecs.open(path, 'r', encoding='utf8') as f:
+        source = f.read()
+    return parse_source((parser_cls, settings, source))
+
+
+def read_headers(parser_cls, settings, path):
+    """
+    Returns the headers of the source file `path` without reading and
+    converting its body. Raises ParserException for invalid headers.
+    """
+    with codecs.open(path, 'r', encoding='utf8') as f:
+        return parser_cls(settings, u'').read_headers(f)
+
 
 def get_parser_for_filename(filename):
     """
     Factory function returning a parser class based on the file extension.
+    The parsers of other packages are loaded when the first extension
+    without a registered parser is looked up.
     """
     ext = splitext(filename)[1][1:]
-    try:
-        return [pair[1] for pair in parser_map if ext in pair[0]][0]
-    except IndexError:
-        return
+    parser_cls = parsers.get(ext)
+    if parser_cls is None and not _entry_points_loaded:
+        load_entry_points()
+        parser_cls = parsers.get(ext)
+    return parser_cls
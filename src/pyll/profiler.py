@@ -0,0 +1,139 @@
+from contextlib import contextmanager
+from functools import partial
+import gc
+import json
+import os
+from os.path import dirname
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+def get_max_rss():
+    "Returns the peak memory usage of this process in bytes or None"
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on os x
+    return max_rss if os.uname()[0] == 'Darwin' else max_rss << 10
+
+def timed(func, item):
+    """
+    Calls `func(item)` and returns a (result, start, end, pid) tuple. Used
+    by Profiler.wrap() to time jobs in worker processes.
+    """
+    start = time.time()
+    result = func(item)
+    return result, start, time.time(), os.getpid()
+
+class Profiler(object):
+    """
+    Records the duration of the phases of a build and of the parse and
+    render jobs of every page. If not `enabled`, nothing is recorded and
+    phase(), wrap() and unwrap() don't add any overhead.
+
+    For every phase the change in the number of objects tracked by the
+    garbage collector and the peak memory usage of the process are
+    recorded, too. Counting the objects walks the whole heap, so it's
+    only done for phases.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.pid = os.getpid()
+        self.phases = []
+        self.jobs = []
+
+    @contextmanager
+    def phase(self, name):
+        "Records the duration of the with block as the phase `name`"
+        if not self.enabled:
+            yield
+            return
+        objects = len(gc.get_objects())
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            self.phases.append({
+                'name': name, 'start': start, 'end': end,
+                'objects': len(gc.get_objects()) - objects,
+                'max_rss': get_max_rss()})
+
+    def wrap(self, func):
+        """
+        Returns `func` wrapped to time every call, for imap_jobs(). The
+        results have to be passed to unwrap().
+        """
+        if not self.enabled:
+            return func
+        return partial(timed, func)
+
+    def unwrap(self, result, category, name):
+        """
+        Records the timing of a `result` of a function returned by wrap()
+        as the job `name` of `category` (e.g. 'parse') and returns the
+        result of the function.
+        """
+        if not self.enabled:
+            return result
+        result, start, end, pid = result
+        self.jobs.append({'name': name, 'category': category,
+                          'start': start, 'end': end, 'pid': pid})
+        return result
+
+    def get_report(self, count=10):
+        "Returns the phases and the `count` slowest jobs as a string"
+        lines = ['phases:']
+        for phase in self.phases:
+            line = '  %8.3fs  %-20s %+d objects' % (
+                    phase['end'] - phase['start'], phase['name'],
+                    phase['objects'])
+            if phase['max_rss'] is not None:
+                line += ', peak %.1f MB' % (phase['max_rss'] / 1048576.0)
+            lines.append(line)
+        jobs = sorted(self.jobs, key=lambda job: job['start'] - job['end'])
+        if jobs:
+            lines.append('slowest pages:')
+        for job in jobs[:count]:
+            lines.append('  %8.3fs  %-8s %s' % (
+                    job['end'] - job['start'], job['category'], job['name']))
+        return '\n'.join(lines)
+
+    def get_trace(self):
+        """
+        Returns the recorded timings as a dict in the Chrome trace event
+        format, which can be loaded in chrome://tracing or Perfetto.
+        """
+        events = []
+        for phase in self.phases:
+            events.append(self._get_event(
+                    phase['name'], 'phase', phase['start'], phase['end'],
+                    self.pid,
+                    {'objects': phase['objects'],
+                     'max_rss': phase['max_rss']}))
+        for job in self.jobs:
+            events.append(self._get_event(
+                    job['name'], job['category'], job['start'], job['end'],
+                    job['pid']))
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def _get_event(self, name, category, start, end, pid, args=None):
+        event = {'name': name, 'cat': category, 'ph': 'X',
+                 'ts': int(start * 1e6), 'dur': int((end - start) * 1e6),
+                 'pid': pid, 'tid': pid}
+        if args:
+            event['args'] = args
+        return event
+
+    def save_trace(self, path):
+        "Writes the Chrome trace to the file `path`"
+        try:
+            os.makedirs(dirname(path))
+        except OSError:
+            pass
+        with open(path, 'w') as f:
+            json.dump(self.get_trace(), f)
@@ -1,10 +1,100 @@
+from email.utils import parsedate_tz, mktime_tz
 import os
 import posixpath
+import socket
+import stat
 from SimpleHTTPServer import SimpleHTTPRequestHandler
 from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+import threading
 import urllib
+import zlib
+
+from pyll.utils import OrderedDict, sendfile
+
+# the url of the Server-Sent Events stream that announces rebuilds
+EVENTS_URL = '/__pyll__/events'
+
+RELOAD_SCRIPT = """<script>
+new EventSource("%s").addEventListener("reload", function() {
+    location.reload();
+});
+</script>""" % EVENTS_URL
+
+# content types that are compressed with gzip if the client accepts it
+COMPRESSIBLE_TYPES = ('application/atom+xml', 'application/javascript',
+                      'application/json', 'application/rss+xml',
+                      'application/x-javascript', 'application/xml',
+                      'image/svg+xml')
+# files larger than this are neither compressed nor read into memory
+MAX_COMPRESS_SIZE = 4 << 20
+# files larger than this are sent with sendfile(), if available
+MIN_SENDFILE_SIZE = 64 << 10
+
+class GzipCache(object):
+    """
+    A thread-safe cache of gzip compressed response bodies that holds at
+    most `max_size` bytes, evicting the least recently used bodies.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.bodies = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, content):
+        "Returns the compressed `content`, which is cached as `key`"
+        with self.lock:
+            body = self.bodies.pop(key, None)
+            if body is not None:
+                self.bodies[key] = body
+                return body
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress(content) + compressor.flush()
+        with self.lock:
+            if key not in self.bodies:
+                self.bodies[key] = body
+                self.size += len(body)
+            while self.size > self.max_size:
+                self.size -= len(self.bodies.popitem(last=False)[1])
+        return body
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    "An HTTPServer that handles every request in a new thread"
+    daemon_threads = True
+
+class ReloadNotifier(object):
+    "Lets request threads wait for the next finished build"
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.build = 0
+
+    def notify(self):
+        "Announces a finished build"
+        with self.condition:
+            self.build += 1
+            self.condition.notify_all()
+
+    def wait(self, build, timeout):
+        """
+        Waits at most `timeout` seconds for a build newer than `build`.
+        Returns the number of the latest build.
+        """
+        with self.condition:
+            if self.build == build:
+                self.condition.wait(timeout)
+            return self.build
 
 class LanyonHTTPRequestHandler(SimpleHTTPRequestHandler):
+    # keep connections alive between requests
+    protocol_version = 'HTTP/1.1'
+    # a MemoryOutput to serve the site from instead of `rootpath`
+    output = None
+    # a ReloadNotifier; if set, browsers are reloaded after every build
+    notifier = None
+    gzip_cache = GzipCache(32 << 20)
+
     def translate_path(self, path):
         """
         The default behavior of SimpleHTTPRequestHandler.translate_path
@@ -30,3 +120,182 @@ class LanyonHTTPRequestHandler(SimpleHTTPRequestHandler):
                 continue
             path = os.path.join(path, word)
         return path
+
+    def do_GET(self):
+        if self.notifier is not None and \
+           self.path.split('?', 1)[0] == EVENTS_URL:
+            self.send_events()
+        else:
+            SimpleHTTPRequestHandler.do_GET(self)
+
+    def send_head(self):
+        """
+        Sends the headers for the requested file, which is served from
+        `output` if it is set or from disk otherwise. Supports conditional
+        requests with ETag and Last-Modified and gzip compression.
+
+        Returns a file object for the body or None if there is no body.
+        """
+        path = self.translate_path(self.path)
+        if self.isdir(path):
+            if not self.path.split('?', 1)[0].endswith('/'):
+                # redirect browser, like SimpleHTTPRequestHandler does
+                self.send_response(301)
+                self.send_header('Location', self.path + '/')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+            index = os.path.join(path, 'index.html')
+            if self.output is None and not os.path.exists(index):
+                return self.list_directory(path)
+            path = index
+
+        resource = self.get_resource(path)
+        if resource is None:
+            self.send_error(404, "File not found")
+            return None
+        content, filename, mtime, size = resource
+        ctype = self.guess_type(path)
+        compressible = (ctype.startswith('text/') or
+                        ctype in COMPRESSIBLE_TYPES) and \
+                       size <= MAX_COMPRESS_SIZE
+        encoding = 'gzip' if compressible and self.accepts_gzip() else None
+        # the compressed body is a different representation, which
+        # needs its own ETag
+        etag = '"%x-%x%s"' % (int(mtime * 1000000), size,
+                              '-gzip' if encoding else '')
+
+        if self.is_not_modified(etag, mtime):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return None
+
+        if content is None and encoding:
+            with open(filename, 'rb') as f:
+                content = f.read()
+        if content is not None and self.notifier is not None and \
+           ctype == 'text/html':
+            content = self.insert_reload_script(content)
+        if encoding:
+            content = self.gzip_cache.get((path, etag), content)
+
+        if content is not None:
+            f = StringIO(content)
+            size = len(content)
+        else:
+            try:
+                f = open(filename, 'rb')
+            except IOError:
+                self.send_error(404, "File not found")
+                return None
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(size))
+        self.send_header('Last-Modified', self.date_time_string(mtime))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        if compressible:
+            self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.end_headers()
+        return f
+
+    def isdir(self, path):
+        if self.output is not None:
+            return self.output.isdir(path)
+        return os.path.isdir(path)
+
+    def get_resource(self, path):
+        """
+        Returns a (content, filename, mtime, size) tuple for `path`. Pages
+        kept in memory have `content`, files on disk have `filename`.
+        Returns None if `path` doesn't exist.
+        """
+        if self.output is not None:
+            # a single lookup, the output changes while the site is rebuilt
+            entry = self.output.get(path)
+            if entry is None:
+                return None
+            content, mtime, filename = entry
+            if content is not None:
+                return content, None, mtime, len(content)
+        else:
+            filename = path
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return None, filename, st.st_mtime, st.st_size
+
+    def is_not_modified(self, etag, mtime):
+        "Checks the If-None-Match and If-Modified-Since request headers"
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return etag in [tag.strip() for tag in if_none_match.split(',')] \
+                   or if_none_match.strip() == '*'
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            date = parsedate_tz(if_modified_since)
+            if date is not None:
+                return int(mtime) <= mktime_tz(date)
+        return False
+
+    def accepts_gzip(self):
+        "Returns True if the client accepts gzip compressed responses"
+        for coding in self.headers.get('Accept-Encoding', '').split(','):
+            params = coding.strip().split(';')
+            if params[0].strip() == 'gzip':
+                return not any(param.strip() in ('q=0', 'q=0.0', 'q=0.00',
+                                                 'q=0.000')
+                               for param in params[1:])
+        return False
+
+    def copyfile(self, source, outputfile):
+        "Sends large files with sendfile(), if available"
+        if sendfile is None or not isinstance(source, file) or \
+           os.fstat(source.fileno()).st_size < MIN_SENDFILE_SIZE:
+            return SimpleHTTPRequestHandler.copyfile(self, source, outputfile)
+        outputfile.flush()
+        offset = 0
+        while True:
+            sent = sendfile(self.connection.fileno(), source.fileno(),
+                            offset, MIN_SENDFILE_SIZE)
+            if sent == 0:
+                break
+            offset += sent
+
+    def insert_reload_script(self, content):
+        "Inserts RELOAD_SCRIPT before the closing body tag of `content`"
+        pos = content.lower().rfind('</body>')
+        if pos == -1:
+            return content + RELOAD_SCRIPT
+        return content[:pos] + RELOAD_SCRIPT + content[pos:]
+
+    def send_events(self):
+        """
+        Streams a "reload" Server-Sent Event whenever a build finishes
+        until the client disconnects.
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        build = self.notifier.build
+        try:
+            self.wfile.write('retry: 1000\n\n')
+            self.wfile.flush()
+            while True:
+                latest = self.notifier.wait(build, 15)
+                if latest != build:
+                    build = latest
+                    self.wfile.write('event: reload\ndata: %s\n\n' % build)
+                else:
+                    # keep-alive comment; fails once the client is gone
+                    self.wfile.write(':\n\n')
+                self.wfile.flush()
+        except (socket.error, IOError):
+            pass
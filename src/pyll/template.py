@@ -1,19 +1,264 @@
+import os
+from os.path import join
+
 from jinja2 import Environment, ChoiceLoader, FileSystemLoader, PackageLoader
-from jinja2 import TemplateNotFound
+from jinja2 import FileSystemBytecodeCache, Undefined
+from jinja2 import TemplateNotFound, TemplateSyntaxError, meta, nodes
+from jinja2.ext import Extension
+from jinja2.runtime import LoopContext
+
+from pyll.manifest import get_hash, get_page_hash
+from pyll.page import Page
 
 class TemplateException(Exception):
     pass
 
+class UncacheableValue(Exception):
+    "Raised for values that can't be part of a fragment cache key"
+    pass
+
+def get_value_key(value):
+    """
+    Returns a representation of `value` that is equal for equal values,
+    also across processes and builds. Raises UncacheableValue if there
+    is none.
+    """
+    if isinstance(value, Page):
+        return get_page_hash(value)
+    if isinstance(value, (list, tuple)):
+        return [get_value_key(item) for item in value]
+    if isinstance(value, dict):
+        return sorted((key, get_value_key(item))
+                      for key, item in value.iteritems())
+    if isinstance(value, (Undefined, LoopContext)) or \
+       type(value).__repr__ is object.__repr__:
+        # other objects are only identified by their address. the repr of
+        # a loop only has its position, not the neighbouring items.
+        raise UncacheableValue(value)
+    return repr(value)
+
+def reads_page_contents(ast):
+    """
+    Returns True if the template `ast` may read the `content` of other
+    pages than `page`, e.g. `{{ post.content }}` in a loop over `pages`.
+    """
+    # `page` is only the rendered page if the template doesn't assign it
+    assigned = set(node.name for node in ast.find_all(nodes.Name)
+                   if node.ctx != 'load')
+    for node in ast.find_all((nodes.Getattr, nodes.Const)):
+        if isinstance(node, nodes.Const):
+            # e.g. post['content'] or pages|map(attribute='content')
+            if node.value == 'content':
+                return True
+        elif node.attr == 'content' and (
+                not isinstance(node.node, nodes.Name) or
+                node.node.name != 'page' or 'page' in assigned):
+            return True
+    return False
+
+class TrackingEnvironment(Environment):
+    """
+    An Environment that records the names of all templates it loads,
+    including the ones loaded through extends, include and import.
+    """
+    def __init__(self, *args, **kwargs):
+        super(TrackingEnvironment, self).__init__(*args, **kwargs)
+        self.loaded_templates = set()
+
+    def _load_template(self, name, globals):
+        self.loaded_templates.add(name)
+        return super(TrackingEnvironment, self)._load_template(name, globals)
+
+class AtomicBytecodeCache(FileSystemBytecodeCache):
+    """
+    A FileSystemBytecodeCache that creates its directory and replaces
+    cache files atomically, so that render workers never read a
+    half-written file.
+
+    Jinja2 stores a checksum of the template source with the bytecode,
+    so a cache file is ignored as soon as the template changes.
+    """
+    def __init__(self, directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+        super(AtomicBytecodeCache, self).__init__(directory)
+
+    def dump_bytecode(self, bucket):
+        filename = self._get_cache_filename(bucket)
+        tmp_filename = '%s.%s.tmp' % (filename, os.getpid())
+        try:
+            with open(tmp_filename, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError):
+            pass
+
+class FragmentCacheExtension(Extension):
+    """
+    Adds the {% cache key %}...{% endcache %} tag, which renders its body
+    once and reuses it wherever the same key (one or more expressions) is
+    used while the variables read by the body have the same values.
+
+    The rendered fragments are stored by the FragmentCache that is set as
+    the `fragment_cache` attribute of the environment.
+    """
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+
+        # the variables and templates the body depends on. the values of
+        # the variables are passed as names, so that loop variables and
+        # other locals of the template are resolved, too.
+        ast = nodes.Template(body, lineno=lineno)
+        ast.set_environment(self.environment)
+        variables = nodes.Dict([
+                nodes.Pair(nodes.Const(name), nodes.Name(name, 'load'))
+                for name in sorted(meta.find_undeclared_variables(ast))])
+        templates = tuple(meta.find_referenced_templates(ast))
+
+        args = [nodes.Const(parser.name), nodes.Const(lineno),
+                nodes.List(key), variables,
+                nodes.Const(templates), nodes.ContextReference()]
+        return nodes.CallBlock(self.call_method('_render', args), [], [],
+                               body).set_lineno(lineno)
+
+    def _render(self, template_name, lineno, key, variables, templates,
+                context, caller):
+        fragment_cache = self.environment.fragment_cache
+        if fragment_cache is None:
+            return caller()
+        return fragment_cache.render(template_name, lineno, key, variables,
+                                     templates, context, caller)
+
+class FragmentCache(object):
+    """
+    Stores the fragments rendered by FragmentCacheExtension for the
+    Jinja2Template `template_cls` in memory and, if `file_cache` is set,
+    in that FileCache, so that they are reused by later builds.
+
+    A fragment is identified by its position, its key and the values of
+    the variables its body and the templates it includes read. `pages`,
+    `site` and `paginator` are represented by `pages_hash`, a hash over
+    all public pages; fragments are only persisted if it is set. A stored
+    fragment is only used while none of the templates that were loaded
+    to render it changed, nor any template the templates loaded before it
+    extend, include or import, as the body can call their macros.
+    """
+    PAGES_VARIABLES = ('pages', 'site', 'paginator')
+
+    def __init__(self, template_cls, file_cache=None, pages_hash=None):
+        self.template_cls = template_cls
+        self.file_cache = file_cache if pages_hash is not None else None
+        self.pages_hash = pages_hash
+        self.fragments = {}
+
+    def _get_key(self, template_name, lineno, key, variables, templates,
+                 context):
+        "Returns the cache key of a fragment or None if it can't be cached"
+        if template_name is None:
+            # the template is the content of a page
+            return None
+        names = set(variables)
+        for name in templates:
+            found = name and self.template_cls.get_variables(name)
+            if found is None:
+                return None
+            names |= found
+        values = []
+        for name in sorted(names):
+            if name in variables:
+                value = variables[name]
+            else:
+                value = context.resolve(name)
+            if value is self.template_cls.env.globals.get(name):
+                continue
+            if name in self.PAGES_VARIABLES:
+                values.append((name, self.pages_hash,
+                               repr(value) if name == 'paginator' else None))
+                continue
+            try:
+                values.append((name, get_value_key(value)))
+            except UncacheableValue:
+                return None
+        try:
+            key = get_value_key(key)
+        except UncacheableValue:
+            return None
+        return get_hash(repr((template_name, lineno, key, values)))
+
+    def render(self, template_name, lineno, key, variables, templates,
+               context, caller):
+        "Returns the stored fragment or renders it by calling `caller`"
+        env = self.template_cls.env
+        cache_key = self._get_key(template_name, lineno, key, variables,
+                                  templates, context)
+        if cache_key is None:
+            return caller()
+
+        fragment = self.fragments.get(cache_key)
+        if fragment is None and self.file_cache is not None:
+            fragment = self.file_cache.get(cache_key)
+            if fragment is not None and any(
+                    self.template_cls.get_template_hash(name) != hash
+                    for name, hash in fragment[1].iteritems()):
+                fragment = None
+        if fragment is not None:
+            env.loaded_templates.update(fragment[1])
+            return fragment[0]
+
+        # record the templates loaded by the body separately
+        loaded_templates = env.loaded_templates
+        env.loaded_templates = set([template_name])
+        try:
+            rendered = caller()
+        finally:
+            fragment_templates = env.loaded_templates
+            env.loaded_templates = loaded_templates | fragment_templates
+        for name in loaded_templates:
+            fragment_templates |= \
+                    self.template_cls.get_templates(name) or set([name])
+        fragment = (rendered, dict(
+                (name, self.template_cls.get_template_hash(name))
+                for name in fragment_templates))
+        self.fragments[cache_key] = fragment
+        if self.file_cache is not None:
+            self.file_cache.set(cache_key, fragment)
+        return rendered
+
 class Jinja2Template(object):
     default_template = 'default.html'
 
-    def __init__(self, settings):
+    def __init__(self, settings, fragment_cache=None, pages_hash=None):
+        """
+        `fragment_cache` is a FileCache that persists the fragments of
+        {% cache %} tags, `pages_hash` the hash over all public pages.
+        """
         self.settings = settings
-        self.env = Environment(loader=ChoiceLoader([
+        bytecode_cache = None
+        if self.settings.get('use_cache'):
+            bytecode_cache = AtomicBytecodeCache(
+                    join(self.settings['cache_dir'], 'templates'))
+        self.env = TrackingEnvironment(loader=ChoiceLoader([
             FileSystemLoader(self.settings['template_dir']),
-            PackageLoader('pyll')]))
+            PackageLoader('pyll')]), bytecode_cache=bytecode_cache,
+            extensions=[FragmentCacheExtension])
         self.env.filters['datetimeformat'] = self.datetimeformat
         self.env.filters['ordinalsuffix'] = self.ordinal_suffix
+        self.env.fragment_cache = FragmentCache(self, fragment_cache,
+                                                pages_hash)
+        self._variables = {}
+        self._hashes = {}
 
     def ordinal_suffix(self, day):
         """
@@ -38,8 +283,30 @@ class Jinja2Template(object):
         """
         return value.strftime(format)
 
+    def compile_templates(self):
+        """
+        Compiles all templates, which fills the bytecode cache. Returns a
+        list of (template_name, error) tuples for the templates that
+        couldn't be compiled.
+        """
+        errors = []
+        for name in self.env.list_templates(
+                filter_func=lambda name: not name.startswith('.') and
+                                         not name.endswith('~')):
+            try:
+                self.env.get_template(name)
+            except (TemplateSyntaxError, UnicodeDecodeError) as error:
+                errors.append((name, error))
+        return errors
+
+    @property
+    def loaded_templates(self):
+        "The names of the templates loaded by the last render"
+        return self.env.loaded_templates
+
     def render_string(self, template_str, **kwargs):
         """Use `template_str` as a template"""
+        self.env.loaded_templates = set()
         template = self.env.from_string(template_str)
         try:
             return template.render(**kwargs)
@@ -48,6 +315,7 @@ class Jinja2Template(object):
 
     def render(self, template_name, **kwargs):
         """Use `template_name` as a template"""
+        self.env.loaded_templates = set()
         try:
             template = self.env.get_template(template_name)
         except TemplateNotFound:
@@ -56,3 +324,83 @@ class Jinja2Template(object):
             return template.render(**kwargs)
         except TemplateNotFound as err:
             raise TemplateException("Template '%s' not found" % err)
+
+    def get_variables(self, template_name=None, source=None):
+        """
+        Returns the set of context variables that are read by the template
+        `template_name` (or the template string `source`) and all templates
+        it extends, includes or imports. Returns None if the variables can't
+        be determined statically, e.g. because a template name is computed
+        at render time.
+        """
+        found = self._inspect(template_name, source)
+        return found and found[0]
+
+    def reads_page_contents(self, template_name=None, source=None):
+        """
+        Returns True if the template `template_name` (or the template
+        string `source`) or a template it extends, includes or imports
+        may read the content of other pages, see reads_page_contents().
+        """
+        found = self._inspect(template_name, source)
+        return found is None or found[1]
+
+    def get_templates(self, template_name):
+        """
+        Returns the set of the names of `template_name` and all templates
+        it extends, includes or imports, directly or not. Returns None if
+        they can't be determined statically.
+        """
+        found = self._inspect(template_name, None)
+        return found and found[2]
+
+    def _inspect(self, template_name, source):
+        if source is None:
+            if template_name not in self._variables:
+                self._variables[template_name] = \
+                        self._find_variables(template_name, set())
+            return self._variables[template_name]
+        return self._find_variables(None, set(), source)
+
+    def _find_variables(self, template_name, seen, source=None):
+        """
+        Returns a (variables, reads_page_contents, template names) tuple
+        for a template and the templates it references or None
+        """
+        try:
+            if source is None:
+                seen.add(template_name)
+                source = self.env.loader.get_source(self.env,
+                                                    template_name)[0]
+            ast = self.env.parse(source)
+        except (TemplateNotFound, TemplateSyntaxError):
+            return None
+        variables = set(meta.find_undeclared_variables(ast))
+        reads_contents = reads_page_contents(ast)
+        for name in meta.find_referenced_templates(ast):
+            if name is None:
+                return None
+            if name in seen:
+                continue
+            found = self._find_variables(name, seen)
+            if found is None:
+                return None
+            variables |= found[0]
+            reads_contents = reads_contents or found[1]
+        # `seen` holds all referenced templates once the recursion is done
+        return variables, reads_contents, frozenset(seen)
+
+    def get_template_hash(self, template_name):
+        """
+        Returns the hash of the source of `template_name` or None if the
+        template doesn't exist.
+        """
+        if template_name not in self._hashes:
+            try:
+                source = self.env.loader.get_source(self.env,
+                                                    template_name)[0]
+            except TemplateNotFound:
+                self._hashes[template_name] = None
+            else:
+                self._hashes[template_name] = get_hash(source)
+        return self._hashes[template_name]
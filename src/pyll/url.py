@@ -1,41 +1,105 @@
-from fnmatch import fnmatch
+from fnmatch import translate
 from os.path import splitext, split, relpath
+import re
+from string import Template
 
 from pyll.utils import OrderedDict
 registry = OrderedDict()
 
+# the Router compiled from the registry, see get_router()
+_router = None
+
+class UrlException(Exception):
+    """Exception raised if two pages are written to the same path."""
+    pass
+
+class Router(object):
+    """
+    The url rules of `registry` compiled for dispatching: the patterns
+    are matched with precompiled regular expressions, the most recently
+    registered pattern first. The catch-all pattern '*' always matches.
+    """
+    def __init__(self, registry):
+        self.patterns = []
+        for pattern in reversed(registry):
+            match = None
+            if pattern != '*':
+                match = re.compile(translate(pattern)).match
+            self.patterns.append((pattern, match, registry[pattern]))
+
+    def get_url_func(self, page):
+        """
+        Returns the url rule that matches the path and the url header
+        value of `page`.
+        """
+        path = page['path']
+        url = page['url']
+        for pattern, match, rules in self.patterns:
+            if match is None or match(path):
+                if url in rules:
+                    return rules[url]
+                elif pattern == '*' and url != 'default':
+                    # special case: user entered something but it isn't
+                    # a url function -> assume its an output path
+                    return lambda page: url
+                elif 'default' in rules:
+                    return rules['default']
+
+def compile_registry():
+    "Compiles the registry; called after the url rules are registered"
+    global _router
+    _router = Router(registry)
+
+def get_router():
+    if _router is None:
+        compile_registry()
+    return _router
+
+class PageVariables(object):
+    """
+    The values of the placeholders in a url: `$year`, `$month` and `$day`
+    of the page date and every header of the page, e.g. `$slug`.
+    """
+    def __init__(self, page):
+        self.page = page
+
+    def __getitem__(self, key):
+        if key == 'year':
+            return '%04d' % self.page['date'].year
+        elif key == 'month':
+            return '%02d' % self.page['date'].month
+        elif key == 'day':
+            return '%02d' % self.page['date'].day
+        return unicode(self.page[key])
+
+def expand_url(url, page):
+    "Replaces the placeholders in `url` (e.g. `$slug`) with page values"
+    if '$' not in url:
+        return url
+    return Template(url).safe_substitute(PageVariables(page))
+
 def get_url(page):
     "Returns the final output url string for `page`"
     urlfunc = get_url_func(page)
     url = urlfunc(page)
-    return url
+    return expand_url(url, page)
 
 def get_url_func(page):
     """
     Returns the entry from the url registry that matches the specified
     url header value.
     """
-    path = page['path']
-    url = page['url']
-    for pattern in reversed(registry):
-        rules = registry[pattern]
-        if fnmatch(path, pattern):
-            if url in rules:
-                return rules[url]
-            elif pattern == '*' and url != 'default':
-                # special case: user entered something but it isn't
-                # a url function -> assume its an output path 
-                return lambda **x: url
-            elif 'default' in rules:
-                return rules['default']
+    return get_router().get_url_func(page)
 
 def register(func=None, match='*'):
     "A registry for url rules"
     def decorated(func):
         # this returns the final, decorated function,
         # regardless of how it was called
+        global _router
         match_rules = registry.setdefault(match, {})
         match_rules[func.__name__] = func
+        _router = None
         def wrapper(*args, **kwargs):
             return func(*args, **kwargs)
         return wrapper
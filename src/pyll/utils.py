@@ -1,52 +1,296 @@
-from fnmatch import fnmatch
+from fnmatch import translate
+from itertools import imap
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from _abcoll import MutableMapping
 from weakref import proxy as _proxy
 import os
+import re
 import shutil
+import stat
 import hashlib
+import threading
 
-def walk_ignore(path):
-    "Custom walker that ignores specific filenames"
-    ignores = ('.*', '*~', '#*', '_*',)
-    for dirpath, dirnames, filenames in os.walk(path):
-        for pattern in ignores:
-            filenames[:] = [n for n in filenames if not fnmatch(n, pattern)]
-            dirnames[:] = [n for n in dirnames if not fnmatch(n, pattern)]
-        yield dirpath, dirnames, filenames
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = None
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = getattr(os, 'scandir', None)
+
+# files are hashed and copied in chunks of this size
+CHUNK_SIZE = 1 << 20
+
+# the ioctl that creates a copy-on-write clone of a file on linux
+FICLONE = 0x40049409
+
+IGNORE_PATTERNS = ('.*', '*~', '#*', '_*',)
+
+def get_ignore_func(patterns=IGNORE_PATTERNS):
+    """
+    Returns a function that returns a true value for the file and
+    directory names that match one of the glob `patterns`.
+    """
+    return re.compile('|'.join(translate(pattern)
+                               for pattern in patterns)).match
+
+# returns a true value if the file or directory `name` should be ignored
+is_ignored = get_ignore_func()
+
+def _list_dir(path, ignore):
+    """
+    Returns the names of the directories in `path` that aren't symlinks,
+    the names of the symlinks to directories and a list of (filename, stat)
+    tuples for the files in `path`. Names matched by `ignore` are skipped.
+    """
+    dirnames, linked_dirnames, files = [], [], []
+    if scandir is not None:
+        for entry in scandir(path):
+            if ignore(entry.name):
+                continue
+            try:
+                if entry.is_dir():
+                    if entry.is_symlink():
+                        linked_dirnames.append(entry.name)
+                    else:
+                        dirnames.append(entry.name)
+                else:
+                    files.append((entry.name, entry.stat()))
+            except OSError:
+                # e.g. a broken symlink
+                pass
+        return dirnames, linked_dirnames, files
+
+    for name in os.listdir(path):
+        if ignore(name):
+            continue
+        filepath = os.path.join(path, name)
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            continue
+        if not stat.S_ISDIR(st.st_mode):
+            files.append((name, st))
+        elif os.path.islink(filepath):
+            linked_dirnames.append(name)
+        else:
+            dirnames.append(name)
+    return dirnames, linked_dirnames, files
+
+def scan(path, ignore=is_ignored):
+    """
+    Walks the directory `path` top-down like os.walk() and yields a
+    (dirpath, dirnames, files) tuple for every directory, where `files` is
+    a list of (filename, stat) tuples. Files and directories whose name is
+    matched by `ignore` are skipped, symlinks to directories aren't
+    followed. Removing names from `dirnames` skips those directories.
+
+    With scandir() every file is stat'ed only once and directories not
+    at all.
+    """
+    stack = [path]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            dirnames, linked_dirnames, files = _list_dir(dirpath, ignore)
+        except OSError:
+            continue
+        names = dirnames + linked_dirnames
+        yield dirpath, names, files
+        stack.extend(os.path.join(dirpath, name) for name in reversed(names)
+                     if name not in linked_dirnames)
 
 def get_hash_from_path(path, algorithm='sha1'):
     "Returns the hash of the file `path`."
-    f = open(path)
-    content = f.read()
-    f.close()
     m = hashlib.new(algorithm)
-    m.update(content)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            m.update(chunk)
     return m.hexdigest()
 
-def copy_file(src, dst):
+def is_same_file(src, dst, src_stat=None):
+    """
+    Returns True if `dst` has the same content as `src`.
+
+    Files with a different size differ, files with the same size and
+    mtime are assumed to be the same. Only otherwise both are hashed.
+    `src_stat` is the stat result of `src`, if known.
+    """
+    try:
+        src_stat = src_stat or os.stat(src)
+        dst_stat = os.stat(dst)
+    except OSError:
+        return False
+    if src_stat.st_size != dst_stat.st_size:
+        return False
+    if int(src_stat.st_mtime) == int(dst_stat.st_mtime):
+        return True
+    if get_hash_from_path(src) != get_hash_from_path(dst):
+        return False
+    # take over the mtime so the next check doesn't need to hash
+    os.utime(dst, (dst_stat.st_atime, src_stat.st_mtime))
+    return True
+
+def _copy_contents(src, dst):
+    "Copies the contents of `src` to `dst`, inside the kernel if possible"
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            offset = 0
+            if sendfile is not None:
+                try:
+                    while True:
+                        sent = sendfile(fdst.fileno(), fsrc.fileno(),
+                                        offset, CHUNK_SIZE)
+                        if sent == 0:
+                            return
+                        offset += sent
+                except OSError:
+                    # the platform can't sendfile() between files
+                    fsrc.seek(offset)
+                    fdst.seek(offset)
+            shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+
+def _reflink(src, dst):
+    "Creates `dst` as a copy-on-write clone of `src`"
+    if fcntl is None:
+        raise IOError('reflinks are not supported on this platform')
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+def get_tmp_path(path):
+    """
+    Returns a temporary path next to `path` that is unique to the current
+    process and thread
+    """
+    return '%s.%d-%d.tmp' % (path, os.getpid(),
+                             threading.current_thread().ident)
+
+def replace_file(src, dst):
+    """
+    Renames the file `src` to `dst`, which atomically replaces `dst`, so
+    that readers get either the old or the new file, never a partial one.
+    """
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if not os.path.exists(dst):
+            raise
+        # windows doesn't rename over existing files
+        os.remove(dst)
+        os.rename(src, dst)
+
+def copy_file(src, dst, mode='copy', src_stat=None):
     """
     Copy `src` to `dst`.
 
     The parent directories for `dst` are created.
 
     To increase performance, this function will check if the file `dst`
-    exists and compare the hash of `src` and `dst`. The file will
-    only be copied if the hashes differ.
+    exists and has the same content as `src` (see is_same_file()). The
+    file will only be copied if the contents differ.
+
+    `mode` is one of 'copy', 'hardlink' (link `dst` to `src`) or
+    'reflink' (copy-on-write clone, falls back to a copy if the file
+    system doesn't support it). Copies keep the mtime of `src`.
+    `src_stat` is the stat result of `src`, if known. The file is created
+    next to `dst` and then renamed, so `dst` is never incomplete.
+
+    Returns True if the file was copied.
     """
     try:
         os.makedirs(os.path.dirname(dst))
     except OSError:
         pass
 
-    if os.path.isfile(dst):
-        src_hash = get_hash_from_path(src)
-        dst_hash = get_hash_from_path(dst)
-        if src_hash == dst_hash:
-            return
+    if os.path.isfile(dst) and is_same_file(src, dst, src_stat):
+        return False
+    # the rename also never writes through a hardlink into the source
+    tmp_path = get_tmp_path(dst)
     try:
-        shutil.copy(src, dst)
-    except IOError:
-        pass
+        if mode == 'hardlink':
+            try:
+                os.link(src, tmp_path)
+                replace_file(tmp_path, dst)
+                return True
+            except OSError:
+                # e.g. the output dir is on a different device
+                _copy_contents(src, tmp_path)
+        elif mode == 'reflink':
+            try:
+                _reflink(src, tmp_path)
+            except IOError:
+                _copy_contents(src, tmp_path)
+        else:
+            _copy_contents(src, tmp_path)
+        shutil.copystat(src, tmp_path)
+        replace_file(tmp_path, dst)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+    return True
+
+def copy_files(files, mode='copy', threads=1, stats=None):
+    """
+    Copies the (src, dst) tuples in `files` with copy_file(), using a pool
+    of `threads` threads. `stats` maps source paths to their stat result.
+    Returns a list with the result of copy_file() for every file.
+    """
+    stats = stats or {}
+    if threads <= 1 or len(files) <= 1:
+        return [copy_file(src, dst, mode, stats.get(src))
+                for src, dst in files]
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(
+                lambda (src, dst): copy_file(src, dst, mode, stats.get(src)),
+                files)
+    finally:
+        pool.close()
+        pool.join()
+
+def imap_jobs(func, items, jobs=1, initializer=None, initargs=()):
+    """
+    Like `itertools.imap`, but runs `func` in a pool of `jobs` worker
+    processes if `jobs` is greater than one. The results are returned
+    in the order of `items`.
+
+    `initializer(*initargs)` is called once in every worker process, or in
+    the current process if no pool is used.
+
+    `func` and `items` must be picklable.
+    """
+    if jobs <= 1 or len(items) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for result in imap(func, items):
+            yield result
+        return
+
+    # like Pool.map, hand out about four chunks per worker
+    chunksize = max(1, len(items) // (jobs * 4))
+    pool = Pool(jobs, initializer, initargs)
+    try:
+        for result in pool.imap(func, items, chunksize):
+            yield result
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
 
 ################################################################################
 ### OrderedDict